@@ -1,14 +1,28 @@
 import ftplib
 import os
+import posixpath
 import ssl
 import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
 from loguru import logger
 
+from bambu_spoolman import metrics
+
+# Directory the printer keeps the models it was sent in
+CACHE_DIRECTORY = "cache"
+
+# Amount of data at the end of a file that is fetched in one go when it is
+# first read. Zip archives keep their central directory there.
+TAIL_SIZE = 64 * 1024
+
 
 class ImplicitFTP_TLS(ftplib.FTP_TLS):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, tls_session=None, **kwargs):
+        self.tls_session = tls_session
         super().__init__(*args, **kwargs)
         self._sock = None
 
@@ -21,7 +35,7 @@ class ImplicitFTP_TLS(ftplib.FTP_TLS):
     def sock(self, value):
         """When modifying the socket, ensure that it is ssl wrapped."""
         if value is not None and not isinstance(value, ssl.SSLSocket):
-            value = self.context.wrap_socket(value)
+            value = self.context.wrap_socket(value, session=self.tls_session)
         self._sock = value
 
     def ntransfercmd(self, cmd, rest=None):
@@ -33,26 +47,458 @@ class ImplicitFTP_TLS(ftplib.FTP_TLS):
         return conn, size
 
 
+def _connect(host, access_code, timeout, context, tls_session=None):
+    ftp = ImplicitFTP_TLS(context=context, tls_session=tls_session)
+    ftp.set_pasv(True)
+    ftp.connect(host, 990, timeout)
+    ftp.login("bblp", access_code)
+    ftp.prot_p()
+    return ftp
+
+
+class Deadline:
+    """
+    The point in time by which an FTP operation has to be completed
+    """
+
+    def __init__(self, seconds):
+        self._expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self._expires - time.monotonic())
+
+    def check(self, operation):
+        if time.monotonic() > self._expires:
+            raise TimeoutError(f"{operation} did not complete in time")
+
+
+class _IdleSession:
+    def __init__(self, ftp):
+        self.ftp = ftp
+        self.idle_since = time.monotonic()
+        self.last_used = self.idle_since
+
+
+class FTPClient:
+    """
+    Hands out logged in sessions to the printer's FTP server
+
+    Sessions are returned to a small pool after use, so consecutive
+    operations skip the connection, TLS handshake and login. Idle sessions
+    are kept alive with NOOPs and closed after ``MAX_IDLE_SECONDS``. New
+    connections resume the TLS session of the previous one.
+
+    Every socket operation is bounded by ``timeout`` and every session by the
+    deadline it was acquired with.
+    """
+
+    # Interval at which idle sessions are checked and kept alive
+    KEEPALIVE_INTERVAL = 30
+
+    # Idle sessions are closed after this many seconds, so that they don't
+    # hold on to one of the few connections the printer accepts
+    MAX_IDLE_SECONDS = 300
+
+    def __init__(self, host, access_code, pool_size=1, timeout=10, deadline=600):
+        self.host = host
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.deadline = deadline
+
+        self._access_code = access_code
+        self._context = ssl.create_default_context()
+        self._context.check_hostname = False
+        self._context.verify_mode = ssl.CERT_NONE
+        self._tls_session = None
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = threading.Event()
+        self._keepalive_thread = None
+
+    @contextmanager
+    def session(self, deadline=None):
+        """
+        Acquires a session for one operation
+
+        Yields the FTP connection and a :class:`Deadline` for the operation. The
+        session is returned to the pool afterwards, unless the operation failed
+        in a way that may have left it in an unknown state.
+        """
+        deadline = Deadline(deadline or self.deadline)
+        ftp = self._acquire()
+        try:
+            yield ftp, deadline
+        except ftplib.error_perm:
+            # A rejected command doesn't affect the session
+            self._release(ftp)
+            raise
+        except BaseException:
+            _close_quietly(ftp)
+            raise
+        self._release(ftp)
+
+    def close(self):
+        """
+        Closes all idle sessions and stops keeping them alive
+        """
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            _close_quietly(session.ftp)
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+            if session is None:
+                return self._open_session()
+
+            if time.monotonic() - session.last_used < self.KEEPALIVE_INTERVAL:
+                metrics.increment("ftp.sessions_reused")
+                return session.ftp
+            # The server may have dropped a session that was quiet for a while
+            try:
+                session.ftp.voidcmd("NOOP")
+            except (OSError, EOFError, ftplib.Error) as e:
+                logger.debug("Discarding stale FTP session: {}", e)
+                _close_quietly(session.ftp)
+                continue
+            metrics.increment("ftp.sessions_reused")
+            return session.ftp
+
+    def _open_session(self):
+        started = time.monotonic()
+        ftp = _connect(
+            self.host,
+            self._access_code,
+            self.timeout,
+            self._context,
+            self._tls_session,
+        )
+        ftp.voidcmd("TYPE I")
+
+        session_reused = getattr(ftp.sock, "session_reused", False)
+        self._tls_session = getattr(ftp.sock, "session", None)
+
+        elapsed = time.monotonic() - started
+        metrics.increment("ftp.sessions_opened")
+        metrics.observe("ftp.session_setup_seconds", elapsed)
+        logger.debug(
+            "Opened FTP session in {:.3f}s (TLS session resumed: {})",
+            elapsed,
+            session_reused,
+        )
+        return ftp
+
+    def _release(self, ftp):
+        with self._lock:
+            if not self._closed.is_set() and len(self._idle) < self.pool_size:
+                self._idle.append(_IdleSession(ftp))
+                ftp = None
+                self._start_keepalive()
+        if ftp is not None:
+            _close_quietly(ftp)
+
+    def _start_keepalive(self):
+        if self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(
+                target=self._keepalive, name="FTPKeepalive", daemon=True
+            )
+            self._keepalive_thread.start()
+
+    def _keepalive(self):
+        while not self._closed.wait(self.KEEPALIVE_INTERVAL):
+            with self._lock:
+                idle, self._idle = self._idle, []
+
+            now = time.monotonic()
+            alive = []
+            for session in idle:
+                if now - session.idle_since > self.MAX_IDLE_SECONDS:
+                    logger.debug("Closing idle FTP session")
+                    _close_quietly(session.ftp)
+                    continue
+                try:
+                    session.ftp.voidcmd("NOOP")
+                except (OSError, EOFError, ftplib.Error) as e:
+                    logger.debug("Idle FTP session was closed: {}", e)
+                    _close_quietly(session.ftp)
+                    continue
+                session.last_used = time.monotonic()
+                alive.append(session)
+
+            with self._lock:
+                self._idle.extend(alive)
+
+
+def _close_quietly(ftp):
+    try:
+        ftp.quit()
+    except (OSError, EOFError, ftplib.Error):
+        ftp.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the FTP client for the printer, configured from the environment
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FTPClient(
+                os.environ.get("PRINTER_IP"),
+                os.environ.get("PRINTER_ACCESS_CODE"),
+                pool_size=int(os.environ.get("BAMBU_SPOOLMAN_FTP_POOL_SIZE", "1")),
+                timeout=float(os.environ.get("BAMBU_SPOOLMAN_FTP_TIMEOUT", "10")),
+                deadline=float(os.environ.get("BAMBU_SPOOLMAN_FTP_DEADLINE", "600")),
+            )
+        return _client
+
+
+def _record_transfer(filename, transferred, elapsed):
+    throughput = transferred / elapsed if elapsed > 0 else 0.0
+    metrics.increment("ftp.bytes_transferred", transferred)
+    metrics.observe("ftp.transfer_seconds", elapsed)
+    metrics.observe("ftp.throughput_bytes_per_second", throughput)
+    logger.debug(
+        "Transferred {} bytes of {} in {:.2f}s ({:.1f} KiB/s)",
+        transferred,
+        filename,
+        elapsed,
+        throughput / 1024,
+    )
+
+
+def _file_size(ftp, filename):
+    # Check if the file exists
+    logger.debug("Checking if file {} exists", filename)
+    try:
+        size = ftp.size(filename)
+        logger.debug("File {} exists, size: {}", filename, size)
+        return size
+    except ftplib.error_perm:
+        logger.error("File {} does not exist", filename)
+        return None
+
+
+def list_3mf(directory=CACHE_DIRECTORY):
+    """
+    Lists the 3mf files in a directory on the printer
+
+    Returns a dict of the path of each file to its size.
+    """
+    with get_client().session() as (ftp, _):
+        try:
+            names = ftp.nlst(directory)
+        except ftplib.error_perm:
+            # An empty directory is reported as an error by some servers
+            return {}
+        finally:
+            # Listing switches the session to ASCII mode, which the pooled
+            # sessions are expected not to be in
+            ftp.voidcmd("TYPE I")
+
+        files = {}
+        for name in names:
+            if not name.endswith(".3mf"):
+                continue
+            path = posixpath.join(directory, posixpath.basename(name))
+            size = _file_size(ftp, path)
+            if size is not None:
+                files[path] = size
+        return files
+
+
 def retrieve_3mf(filename):
     logger.debug("Retrieving cached 3mf file {}", filename)
-    with ImplicitFTP_TLS() as ftp:
-        ftp.set_pasv(True)
-        ftp.connect(os.environ.get("PRINTER_IP"), 990, 5)
-        ftp.login("bblp", os.environ.get("PRINTER_ACCESS_CODE"))
-        ftp.prot_p()
-
-        # Check if the file exists
-        logger.debug("Checking if file {} exists", filename)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".3mf") as f:
         try:
-            size = ftp.size(filename)
-            logger.debug("File {} exists, size: {}", filename, size)
-        except ftplib.error_perm:
-            logger.error("File {} does not exist", filename)
-            return None
+            if not _transfer(filename, f.write):
+                os.remove(f.name)
+                return None
+        except BaseException:
+            os.remove(f.name)
+            raise
+        return f.name
+
+
+def stream_3mf(filename, write):
+    """
+    Transfers a cached 3mf file, passing its contents to ``write`` in chunks as
+    they are received
+    """
+    logger.debug("Streaming cached 3mf file {}", filename)
+    if not _transfer(filename, write):
+        raise FileNotFoundError(f"File {filename} does not exist")
+
+
+def _transfer(filename, write):
+    """
+    Transfers a file to ``write``, returns False if the file does not exist
+    """
+    with get_client().session() as (ftp, deadline):
+        if _file_size(ftp, filename) is None:
+            return False
+
+        transferred = 0
+
+        def receive(chunk):
+            nonlocal transferred
+            deadline.check(f"Transfer of {filename}")
+            transferred += len(chunk)
+            write(chunk)
 
         # Get the file
         logger.debug("Retrieving file {}", filename)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".3mf") as f:
-            ftp.retrbinary(f"RETR {filename}", f.write)
-            logger.debug("File retrieved")
-            return f.name
+        started = time.monotonic()
+        ftp.retrbinary(f"RETR {filename}", receive)
+        _record_transfer(filename, transferred, time.monotonic() - started)
+        logger.debug("File retrieved")
+        return True
+
+
+class RemoteFile:
+    """
+    A read-only, seekable file on the printer's FTP server
+
+    Only the byte ranges that are read are transferred. Sequential reads
+    continue the current transfer, while a read anywhere else restarts the
+    transfer at that offset using REST. The end of the file is fetched once
+    and kept in memory, as that is where zip archives keep their central
+    directory.
+    """
+
+    def __init__(self, ftp, filename, size, deadline=None):
+        self.name = filename
+        self.size = size
+        self.bytes_transferred = 0
+
+        self._ftp = ftp
+        self._deadline = deadline
+        self._position = 0
+
+        self._tail_start = max(0, size - TAIL_SIZE)
+        self._tail = None
+
+        self._transfer = None
+        self._stream = None
+        self._stream_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self.size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b""
+        if self._deadline is not None:
+            self._deadline.check(f"Reading {self.name}")
+
+        if self._position >= self._tail_start:
+            data = self._read_tail(size)
+        else:
+            data = self._read_transfer(size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._close_transfer()
+        self._tail = None
+
+    def _read_tail(self, size):
+        if self._tail is None:
+            logger.debug("Fetching last {} bytes of {}", TAIL_SIZE, self.name)
+            self._open_transfer(self._tail_start)
+            self._tail = self._stream.read()
+            self.bytes_transferred += len(self._tail)
+            self._close_transfer(complete=True)
+
+        offset = self._position - self._tail_start
+        return self._tail[offset : offset + size]
+
+    def _read_transfer(self, size):
+        if self._stream_position != self._position:
+            self._close_transfer()
+            self._open_transfer(self._position)
+
+        data = self._stream.read(size)
+        self._stream_position += len(data)
+        self.bytes_transferred += len(data)
+        return data
+
+    def _open_transfer(self, offset):
+        logger.debug("Reading {} from offset {}", self.name, offset)
+        self._transfer = self._ftp.transfercmd(f"RETR {self.name}", rest=offset or None)
+        self._stream = self._transfer.makefile("rb")
+        self._stream_position = offset
+
+    def _close_transfer(self, complete=False):
+        if self._transfer is None:
+            return
+
+        self._stream.close()
+        if complete and isinstance(self._transfer, ssl.SSLSocket):
+            self._transfer.unwrap()
+        self._transfer.close()
+        self._transfer = None
+        self._stream = None
+        self._stream_position = None
+
+        # An aborted transfer is answered with an error by the server
+        try:
+            self._ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_reply) as e:
+            if complete:
+                raise
+            logger.debug("Transfer of {} aborted: {}", self.name, e)
+
+
+@contextmanager
+def open_3mf(filename):
+    """
+    Opens a cached 3mf file on the printer for random access
+
+    Yields a :class:`RemoteFile`, or None if the file does not exist. Unlike
+    :func:`retrieve_3mf` the file is not downloaded, only the parts of it that
+    are read are transferred.
+    """
+    logger.debug("Opening cached 3mf file {}", filename)
+    with get_client().session() as (ftp, deadline):
+        size = _file_size(ftp, filename)
+        if size is None:
+            yield None
+            return
+
+        remote_file = RemoteFile(ftp, filename, size, deadline)
+        started = time.monotonic()
+        try:
+            yield remote_file
+        finally:
+            remote_file.close()
+            _record_transfer(
+                filename, remote_file.bytes_transferred, time.monotonic() - started
+            )
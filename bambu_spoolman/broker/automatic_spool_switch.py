@@ -4,7 +4,7 @@ from loguru import logger
 
 from bambu_spoolman.bambu_mqtt import stateful_printer_info
 from bambu_spoolman.settings import load_settings, save_settings
-from bambu_spoolman.spoolman import new_client
+from bambu_spoolman.spoolman import instance as spoolman_instance
 
 UNKNOWN_TRAY = "00000000000000000000000000000000"
 
@@ -19,7 +19,7 @@ class AutomaticSpoolSwitch:
         return cls._INSTANCE
 
     def __init__(self):
-        self.spoolman_client = new_client()
+        self.spoolman_client = spoolman_instance()
         self.tray_mapping = None
         self.auto_create_enabled = (
             os.environ.get("SPOOLMAN_AUTO_CREATE_SPOOLS", "false").lower() == "true"
@@ -115,7 +115,11 @@ class AutomaticSpoolSwitch:
         # Try to auto-create if enabled and tray_uuid is valid (not empty/unknown)
         if self.auto_create_enabled and tray_uuid and tray_uuid != UNKNOWN_TRAY:
             logger.info("Auto-creating spool for tray_uuid: {}", tray_uuid)
-            spool = self.spoolman_client.auto_create_spool_from_tray(tray)
+            # Record the tray on the new spool right away, so locking it
+            # doesn't need another update
+            spool = self.spoolman_client.auto_create_spool_from_tray(
+                tray, ams_num=(tray_id // 4) + 1, tray_num=(tray_id % 4) + 1
+            )
             if spool is not None:
                 spool_id = spool["id"]
                 logger.info("Auto-created spool {}", spool_id)
@@ -149,6 +153,18 @@ class AutomaticSpoolSwitch:
         ams_num = (tray_id // 4) + 1
         tray_num = (tray_id % 4) + 1
 
+        # A spool swapped out without the tray being seen empty is still
+        # recorded in this tray in Spoolman
+        previous = self._spool_in_tray(ams_num, tray_num)
+        if previous is not None and previous["id"] != spool_id:
+            try:
+                self.spoolman_client.set_active_tray(previous["id"], None, None)
+                logger.info("Cleared tray fields for spool {}", previous["id"])
+            except Exception as e:
+                logger.error(
+                    "Failed to clear tray fields for spool {}: {}", previous["id"], e
+                )
+
         try:
             self.spoolman_client.set_active_tray(spool_id, ams_num, tray_num)
             logger.info(
@@ -184,6 +200,13 @@ class AutomaticSpoolSwitch:
         save_settings(settings)
         logger.debug("Unlocked tray {}: {}", tray_id, locked)
 
+        if clear and spool_id is None:
+            # The tray wasn't assigned locally, but Spoolman may still record a
+            # spool in it
+            spool = self._spool_in_tray((tray_id // 4) + 1, (tray_id % 4) + 1)
+            if spool is not None:
+                spool_id = spool["id"]
+
         # Clear the tray fields in Spoolman if we're clearing the local mapping
         if clear and spool_id is not None:
             try:
@@ -193,3 +216,18 @@ class AutomaticSpoolSwitch:
                 logger.error(
                     "Failed to clear tray fields for spool {}: {}", spool_id, e
                 )
+
+    def _spool_in_tray(self, ams_num, tray_num):
+        """
+        Returns the spool Spoolman records in an AMS tray, if any
+        """
+        try:
+            return self.spoolman_client.lookup_by_tray(ams_num, tray_num)
+        except Exception as e:
+            logger.warning(
+                "Failed to look up the spool in AMS {} tray {}: {}",
+                ams_num,
+                tray_num,
+                e,
+            )
+            return None
@@ -30,7 +30,7 @@ def _save_checkpoint_metadata(metadata):
 
 def save_checkpoint(
     *,
-    model_path,
+    layer_usage,
     current_layer,
     task_id,
     subtask_id,
@@ -38,7 +38,10 @@ def save_checkpoint(
     gcode_file_name,
     using_ams,
 ):
-    shutil.copy(model_path, os.path.join(checkpoint_directory(), "model.3mf"))
+    # Save the evaluated usage rather than the model, so resuming doesn't need
+    # the model or its gcode
+    with open(os.path.join(checkpoint_directory(), "usage.json"), "w") as f:
+        json.dump(layer_usage, f)
 
     existing_metadata = get_checkpoint_metadata()
     existing_metadata["task_id"] = task_id
@@ -82,14 +85,20 @@ def recover_model(task_id, subtask_id):
             subtask_id,
         )
         return None
-    # Checkpoint is valid, load the model
+    # Checkpoint is valid, load the usage
 
-    model_path = os.path.join(checkpoint_directory(), "model.3mf")
+    usage_path = os.path.join(checkpoint_directory(), "usage.json")
 
-    if not os.path.exists(model_path):
-        logger.error("Model file does not exist")
+    if not os.path.exists(usage_path):
+        logger.error("Usage file does not exist")
         return None
 
+    with open(usage_path) as f:
+        layer_usage = {
+            int(layer): {int(filament): usage for filament, usage in usage.items()}
+            for layer, usage in json.load(f).items()
+        }
+
     current_layer = metadata.get("current_layer")
     ams_mapping = metadata.get("ams_mapping")
     gcode_file_name = metadata.get("gcode_file_name")
@@ -100,8 +109,9 @@ def recover_model(task_id, subtask_id):
         # the mapping.
         using_ams = bool(ams_mapping and ams_mapping[0] not in (-1, 255))
 
-    if current_layer is None or gcode_file_name is None:
+    if current_layer is None:
         logger.error("Checkpoint metadata is incomplete")
         return None
 
-    return model_path, gcode_file_name, current_layer, ams_mapping, using_ams
+    logger.debug("Recovered checkpoint for gcode file {}", gcode_file_name)
+    return layer_usage, current_layer, ams_mapping, using_ams
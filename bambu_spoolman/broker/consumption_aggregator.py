@@ -0,0 +1,152 @@
+import threading
+
+import requests
+from loguru import logger
+
+DEFAULT_INTERVAL = 30
+DEFAULT_THRESHOLD_MM = 1000
+# Seconds before usage that failed to send is retried, without an interval
+RETRY_INTERVAL = 30
+
+
+class ConsumptionAggregator:
+    """
+    Accumulates the filament spent on each spool and consumes it from Spoolman
+    in batches
+
+    Pending usage is sent every ``interval`` seconds, as soon as a spool has
+    ``threshold`` mm pending, or when ``flush`` is called. With an ``interval``
+    of 0, usage is sent as soon as it is added instead. Usage that fails to
+    send stays pending and is retried with the next batch.
+
+    If a journal is given, usage is written to it before it is added, and the
+    usage left in it by a previous run is sent again.
+    """
+
+    def __init__(
+        self,
+        spoolman_client,
+        interval=DEFAULT_INTERVAL,
+        threshold=DEFAULT_THRESHOLD_MM,
+        journal=None,
+    ):
+        self.spoolman_client = spoolman_client
+        self.interval = interval
+        self.threshold = threshold
+        self.journal = journal
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        # Spool ID -> keys of the journal records in its pending usage
+        self._keys = {}
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        if journal is not None:
+            for record in journal.pending():
+                self._pending_add(record["spool_id"], record["length"], record["key"])
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="ConsumptionAggregator", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background flushes and sends everything that is pending
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+    def add(self, spool_id, length):
+        key = None
+        if self.journal is not None:
+            key = self.journal.append(spool_id, length)
+
+        with self._lock:
+            pending = self._pending_add(spool_id, length, key)
+        if self.interval <= 0 or pending >= self.threshold:
+            self.flush_soon()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def flush_soon(self):
+        """
+        Makes the background thread send everything that is pending now
+        """
+        self._wake.set()
+
+    def flush(self):
+        """
+        Sends the usage pending for every spool
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, keys = self._pending, self._keys
+                self._pending, self._keys = {}, {}
+
+            sent_keys = []
+            for spool_id, length in pending.items():
+                logger.debug("Consuming {}mm from spool {}", length, spool_id)
+                try:
+                    self.spoolman_client.consume_spool(spool_id, length=length)
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code < 500:
+                        # Spoolman rejected it, sending it again won't help
+                        logger.error(
+                            "Spoolman refused consuming {}mm from spool {}: {}",
+                            length,
+                            spool_id,
+                            e,
+                        )
+                        sent_keys.extend(keys.get(spool_id, []))
+                        continue
+                    self._retry_later(spool_id, length, keys.get(spool_id, []), e)
+                except Exception as e:
+                    self._retry_later(spool_id, length, keys.get(spool_id, []), e)
+                else:
+                    sent_keys.extend(keys.get(spool_id, []))
+
+            if self.journal is not None and sent_keys:
+                self.journal.ack(sent_keys)
+
+    def _retry_later(self, spool_id, length, keys, error):
+        logger.warning(
+            "Failed to consume {}mm from spool {}, will retry: {}",
+            length,
+            spool_id,
+            error,
+        )
+        with self._lock:
+            self._pending[spool_id] = self._pending.get(spool_id, 0) + length
+            self._keys.setdefault(spool_id, []).extend(keys)
+
+    def _pending_add(self, spool_id, length, key):
+        pending = self._pending.get(spool_id, 0) + length
+        self._pending[spool_id] = pending
+        if key is not None:
+            self._keys.setdefault(spool_id, []).append(key)
+        return pending
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.interval > 0:
+                timeout = self.interval
+            else:
+                with self._lock:
+                    timeout = RETRY_INTERVAL if self._pending else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+            self.flush()
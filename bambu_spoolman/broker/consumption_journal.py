@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import uuid
+
+from loguru import logger
+
+from bambu_spoolman.settings import get_configuration_path
+
+JOURNAL_FILE = "consumption.jsonl"
+
+
+class ConsumptionJournal:
+    """
+    An append-only log of filament usage that hasn't been consumed from
+    Spoolman yet
+
+    Every record is written and synced to disk before it is sent, and carries
+    a unique key. Records are acknowledged by key once Spoolman has accepted
+    them, which rewrites the journal with only the records still pending. The
+    records left in the journal are sent again after a restart.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_configuration_path(JOURNAL_FILE)
+
+        self._lock = threading.Lock()
+        self._records = self._load()
+        self._file = open(self.path, "a")
+        # Drop any record that was only partly written before appending to it
+        self._compact()
+
+    def pending(self):
+        """
+        Returns the records that haven't been acknowledged, oldest first
+        """
+        with self._lock:
+            return list(self._records.values())
+
+    def append(self, spool_id, length):
+        """
+        Durably records usage of a spool and returns the key of the record
+        """
+        record = {"key": uuid.uuid4().hex, "spool_id": spool_id, "length": length}
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records[record["key"]] = record
+        return record["key"]
+
+    def ack(self, keys):
+        """
+        Removes the records with the given keys from the journal
+        """
+        with self._lock:
+            for key in keys:
+                self._records.pop(key, None)
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _load(self):
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The daemon stopped halfway through writing a record
+                        logger.warning("Skipping incomplete consumption record")
+                        continue
+                    records[record["key"]] = record
+        except FileNotFoundError:
+            pass
+
+        if records:
+            logger.info("Loaded {} unsent consumption records", len(records))
+        return records
+
+    def _compact(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            for record in self._records.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "a")
@@ -1,11 +1,15 @@
 import os
 import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from functools import partial
 from urllib.parse import urlparse
 
 import requests
 from loguru import logger
 
-from bambu_spoolman.bambu_ftp import retrieve_3mf
+from bambu_spoolman.bambu_ftp import open_3mf, retrieve_3mf, stream_3mf
 from bambu_spoolman.broker.checkpoint import (
     clear as clear_checkpoint,
 )
@@ -14,24 +18,44 @@ from bambu_spoolman.broker.checkpoint import (
     save_checkpoint,
     update_layer,
 )
-from bambu_spoolman.gcode.bambu import extract_gcode
-from bambu_spoolman.gcode.parser import evaluate_gcode
+from bambu_spoolman.gcode.bambu import evaluate_model, evaluate_model_stream
+from bambu_spoolman.gcode.slice_info import check_totals
+from bambu_spoolman.gcode.usage import LayerUsage
 from bambu_spoolman.settings import EXTERNAL_SPOOL_ID, load_settings
-from bambu_spoolman.spoolman import new_client
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
 
 
 class FilamentUsageTracker:
-    def __init__(self):
-        self.spoolman_client = new_client()
+    def __init__(self, consumption, prefetcher=None):
+        # Journals the filament spent and consumes it from Spoolman
+        self.consumption = consumption
+        self.prefetcher = prefetcher
         self.active_model = None
         self.ams_mapping = None
         self.spent_layers = set()
         self.using_ams = False
 
+        # The slicer's filament totals of the print, if they are read
+        self.slice_totals = None
+
         self.gcode_state = None
         self.current_layer = None
+        self.tray_now = None
+
+        # Models are loaded on a background thread. While a load is in progress
+        # this holds the event used to cancel it, and layer changes are queued
+        # until the model is ready.
+        self._lock = threading.RLock()
+        self._load_cancelled = None
+        self._pending_layers = []
+        self._layer_at_load_start = None
 
     def on_message(self, mqtt_handler, message):
+        with self._lock:
+            self._on_message(message)
+
+    def _on_message(self, message):
         print_obj = message.get("print", {})
         command = print_obj.get("command")
 
@@ -45,6 +69,13 @@ class FilamentUsageTracker:
             self._handle_print_start(print_obj)
 
         if command == "push_status":
+            tray_now = print_obj.get("ams", {}).get("tray_now")
+            if tray_now is not None and tray_now != self.tray_now:
+                if self.tray_now is not None:
+                    logger.debug("Tool changed: {} -> {}", self.tray_now, tray_now)
+                    self._flush_consumption()
+                self.tray_now = tray_now
+
             if "layer_num" in print_obj:
                 last_layer = self.current_layer
                 layer = print_obj["layer_num"]
@@ -56,14 +87,14 @@ class FilamentUsageTracker:
             if (
                 self.gcode_state == "FINISH"
                 and previous_gcode_state != "FINISH"
-                and self.active_model is not None
+                and self._is_tracking()
             ):
                 self._handle_print_end()
 
             if (
                 self.gcode_state == "FAILURE"
                 and previous_gcode_state != "FAILURE"
-                and self.active_model is not None
+                and self._is_tracking()
             ):
                 self._handle_print_failure()
 
@@ -71,6 +102,7 @@ class FilamentUsageTracker:
                 self.gcode_state == "RUNNING"
                 and previous_gcode_state != "RUNNING"
                 and self.active_model is None
+                and not self._is_loading()
             ):
                 # The print is in progress, but we don't have a model loaded.
                 # Check if we saved the model when the print was started and attempt to
@@ -84,12 +116,9 @@ class FilamentUsageTracker:
         clear_checkpoint()
         model_url = print_obj.get("url")
 
+        self.active_model = None
         self.spent_layers = set()
-
-        model = self._retrieve_model(model_url)
-        if model is None:
-            logger.error("Failed to retrieve model. Print will not be tracked")
-            return
+        self.slice_totals = None
 
         ams_mapping = print_obj.get("ams_mapping", [])
         if print_obj.get("use_ams", False) or (
@@ -104,27 +133,231 @@ class FilamentUsageTracker:
             self.using_ams = False
             self.ams_mapping = None  # Ensure this is cleared out
 
+        self._start_model_load(self._load_print_start_model, model_url, print_obj)
+
+    def _load_print_start_model(self, cancelled, model_url, print_obj):
         gcode_file_name = print_obj.get("param")
 
-        self._load_model(model, gcode_file_name)
+        on_slice_totals = None
+        if _slice_info_enabled():
+            on_slice_totals = partial(self._set_slice_totals, cancelled)
+
+        layer_usage = self._evaluate_print_start_model(
+            cancelled, model_url, gcode_file_name, on_slice_totals
+        )
+
+        if layer_usage is not None and not cancelled.is_set():
+            try:
+                save_checkpoint(
+                    layer_usage=layer_usage,
+                    current_layer=0,
+                    task_id=print_obj.get("task_id"),
+                    subtask_id=print_obj.get("subtask_id"),
+                    ams_mapping=self.ams_mapping,
+                    gcode_file_name=gcode_file_name,
+                    using_ams=self.using_ams,
+                )
+            except (OSError, ValueError) as e:
+                # The print is still tracked, it just can't be resumed
+                logger.error("Failed to save checkpoint: {}", e)
+
+        with self._lock:
+            if not self._finish_model_load(cancelled, layer_usage):
+                return
+
+            # Replay the layer changes from the layer the print started at
+            self.current_layer = self._layer_at_load_start
+
+            # Spend layer 0 filament
+            self._handle_layer_change(0)
+            self._settle_pending_layers()
+
+    def _evaluate_print_start_model(
+        self, cancelled, model_url, gcode_file_name, on_slice_totals
+    ):
+        prefetched = self._get_prefetched_model(model_url, gcode_file_name)
+        if prefetched is not None:
+            logger.info("Using prefetched model")
+            layer_usage, slice_totals = prefetched
+            if on_slice_totals is not None and slice_totals is not None:
+                on_slice_totals(slice_totals)
+            return layer_usage
+
+        produce = self._model_producer(model_url)
+        if produce is not None:
+            try:
+                layer_usage = evaluate_model_stream(
+                    produce, gcode_file_name, cancelled, on_slice_totals
+                )
+            except zipfile.BadZipFile as e:
+                logger.warning("Could not stream model, downloading it instead: {}", e)
+            except (OSError, requests.RequestException) as e:
+                logger.error(
+                    "Failed to retrieve model. Print will not be tracked: {}", e
+                )
+                return None
+            else:
+                if layer_usage is None and not cancelled.is_set():
+                    logger.error("Failed to extract gcode from model")
+                return layer_usage
+
+        with self._open_model(model_url) as model:
+            if model is None:
+                logger.error("Failed to retrieve model. Print will not be tracked")
+                return None
+
+            return self._load_model(model, gcode_file_name, cancelled, on_slice_totals)
+
+    def _get_prefetched_model(self, model_url, gcode_file_name):
+        if self.prefetcher is None:
+            return None
+
+        uri = urlparse(model_url)
+        if uri.scheme not in ("file", "ftp", "brtc"):
+            return None
+
+        path = _strip_mount_prefix(f"{uri.netloc}{uri.path}")
+        try:
+            return self.prefetcher.get(path, gcode_file_name)
+        except Exception as e:
+            logger.warning("Could not check for a prefetched model: {}", e)
+            return None
+
+    def _start_model_load(self, target, *args):
+        """
+        Starts loading a model on a background thread
+
+        ``target`` is called with an event that is set if the load is
+        cancelled, followed by ``args``.
+        """
+        self._cancel_model_load()
+
+        cancelled = threading.Event()
+        self._load_cancelled = cancelled
+        self._pending_layers = []
+        self._layer_at_load_start = self.current_layer
+
+        thread = threading.Thread(
+            target=self._run_model_load,
+            args=(target, cancelled, *args),
+            name="ModelLoader",
+            daemon=True,
+        )
+        thread.start()
+
+    def _run_model_load(self, target, cancelled, *args):
+        try:
+            target(cancelled, *args)
+        except Exception as e:
+            logger.exception(f"Error occurred while loading model: {e}")
+            with self._lock:
+                # Only a load that is still in progress failed. Once the model
+                # is active, or another load replaced this one, there is
+                # nothing left to finish.
+                if self._load_cancelled is cancelled:
+                    self._finish_model_load(cancelled, None)
+
+    def _finish_model_load(self, cancelled, layer_usage):
+        """
+        Makes the loaded model active, unless the load was cancelled
+
+        Returns True if the model is now active.
+        """
+        with self._lock:
+            if cancelled.is_set() or self._load_cancelled is not cancelled:
+                logger.info("Model load was cancelled")
+                return False
+            self._load_cancelled = None
+
+            if layer_usage is None:
+                self._pending_layers = []
+                return False
+            self.active_model = LayerUsage(layer_usage)
+            logger.info("Model loaded successfully")
+
+            totals = self.active_model.totals()
+            for filament, usage in totals.items():
+                logger.info("Filament {} usage: {}mm", filament, usage)
+
+            if self.slice_totals is not None and check_totals(
+                totals, self.slice_totals
+            ):
+                logger.info("Filament usage matches the slicer's totals")
+            return True
+
+    def _set_slice_totals(self, cancelled, slice_totals):
+        with self._lock:
+            if cancelled.is_set() or self._load_cancelled is not cancelled:
+                return
+            self.slice_totals = slice_totals
+
+            for filament, usage in slice_totals.items():
+                logger.info(
+                    "Filament {} usage reported by slicer: {}mm", filament, usage
+                )
 
-        save_checkpoint(
-            model_path=model,
-            current_layer=0,
-            task_id=print_obj.get("task_id"),
-            subtask_id=print_obj.get("subtask_id"),
-            ams_mapping=self.ams_mapping,
-            gcode_file_name=gcode_file_name,
-            using_ams=self.using_ams,
+    def _cancel_model_load(self):
+        if self._load_cancelled is not None:
+            logger.info("Cancelling model load")
+            self._load_cancelled.set()
+            self._load_cancelled = None
+        self._pending_layers = []
+
+    def _is_loading(self):
+        return self._load_cancelled is not None
+
+    def _is_tracking(self):
+        return (
+            self.active_model is not None
+            or self.slice_totals is not None
+            or self._is_loading()
         )
 
-        # Delete the downloaded model
-        os.remove(model)
+    def _settle_pending_layers(self):
+        """
+        Settles the layer changes that arrived while the model was loading
+        """
+        pending_layers = self._pending_layers
+        self._pending_layers = []
+        if pending_layers:
+            logger.debug("Settling layer changes {} queued during load", pending_layers)
+
+        for layer in pending_layers:
+            self._handle_layer_change(layer)
+            self.current_layer = layer
+
+    def _model_producer(self, model_url):
+        """
+        Returns a function that transfers the model at the given URL in chunks,
+        or None if the model can't be streamed
+        """
+        ftp_uris = ("file", "ftp", "brtc")
 
-        # Spend layer 0 filament
-        self._handle_layer_change(0)
+        uri = urlparse(model_url)
 
-    def _retrieve_model(self, model_url):
+        if uri.scheme == "https" or uri.scheme == "http":
+            return lambda write: self._stream_download(model_url, write)
+        elif uri.scheme in ftp_uris and not _partial_fetch_enabled():
+            path = _strip_mount_prefix(f"{uri.netloc}{uri.path}")
+            return lambda write: stream_3mf(path, write)
+        return None
+
+    def _stream_download(self, model_url, write):
+        logger.debug("Streaming model from URL: {}", model_url)
+
+        with requests.get(model_url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                write(chunk)
+
+    @contextmanager
+    def _open_model(self, model_url):
+        """
+        Opens the model at the given URL for reading
+
+        Yields the path to a downloaded copy of the model, a file-like object
+        for reading it in place, or None if it could not be retrieved.
+        """
         logger.debug("Loading model from URL: {}", model_url)
 
         ftp_uris = ("file", "ftp", "brtc")
@@ -132,16 +365,33 @@ class FilamentUsageTracker:
         # Turn URL into a URI
         uri = urlparse(model_url)
 
+        if uri.scheme in ftp_uris and _partial_fetch_enabled():
+            path = _strip_mount_prefix(f"{uri.netloc}{uri.path}")
+            with open_3mf(path) as model:
+                yield model
+            return
+
         if uri.scheme == "https" or uri.scheme == "http":
-            return self._download_model(model_url)
+            model = self._download_model(model_url)
         elif uri.scheme in ftp_uris:
             path = f"{uri.netloc}{uri.path}"
-            return self._retrieve_model_from_ftp(path)
+            model = self._retrieve_model_from_ftp(path)
         else:
             logger.warning("Unsupported model URL: {}", model_url)
-            return None
+            model = None
+
+        try:
+            yield model
+        finally:
+            # Delete the downloaded model
+            if model is not None:
+                os.remove(model)
 
     def _handle_layer_change(self, layer):
+        if self._is_loading():
+            logger.debug("Queueing layer change to {} until model is loaded", layer)
+            self._pending_layers.append(layer)
+            return
         if self.active_model is None:
             logger.debug("Skipping layer change because no model is loaded")
             return
@@ -159,56 +409,83 @@ class FilamentUsageTracker:
             # Spend layers between the last layer and the current layer
             logger.debug("Last layer: {}", last_layer)
             logger.debug("Current layer: {}", layer)
-            to_spend = set(range(last_layer + 1, layer + 1))
-            logger.debug("Spending layers: {}", to_spend)
-            for i in to_spend:
-                self._spend_filament_for_layer(i)
-        update_layer(layer)
+            self._spend_filament_for_layers(last_layer + 1, layer)
+        try:
+            update_layer(layer)
+        except (OSError, ValueError) as e:
+            logger.error("Failed to update checkpoint to layer {}: {}", layer, e)
 
     def _handle_print_end(self):
         logger.info("Print ended!")
 
-        # Spend all layers that haven't already been spent
-        if self.active_model is not None:
-            for layer in set(self.active_model.keys()) - self.spent_layers:
+        # The print is over before its model could be loaded
+        self._cancel_model_load()
+
+        # Spend all layers after the current layer, as they weren't reported
+        # during the print
+        if self.active_model is not None and self.current_layer:
+            last_layer = self.active_model.last_layer
+            if last_layer > self.current_layer:
                 logger.debug(
-                    f"Spending layer {layer} as it was not spent during the print"
+                    "Spending layers {}-{} as they were not spent during the print",
+                    self.current_layer + 1,
+                    last_layer,
                 )
-                self._handle_layer_change(layer)
+                self._spend_filament_for_layers(self.current_layer + 1, last_layer)
+        elif self.active_model is None and self.slice_totals is not None:
+            # The model was never evaluated, so no layers were spent. Settle the
+            # whole print with the slicer's totals instead.
+            logger.info("Spending the slicer's totals as the model was not loaded")
+            self._spend_filament(self.slice_totals)
 
         self.active_model = None
+        self.slice_totals = None
         self.ams_mapping = None
         self.using_ams = False
         self.current_layer = None
 
+        self._flush_consumption()
         clear_checkpoint()
 
     def _handle_print_failure(self):
         logger.info("Print failed!")
 
+        self._cancel_model_load()
+
         self.active_model = None
+        self.slice_totals = None
         self.ams_mapping = None
         self.using_ams = False
         self.current_layer = None
 
+        self._flush_consumption()
         clear_checkpoint()
 
-    def _spend_filament_for_layer(self, layer):
+    def _spend_filament_for_layers(self, first_layer, last_layer):
         if self.active_model is None:
             return
-        logger.debug("Spending filament for layer {}", layer)
+        logger.debug("Spending filament for layers {}-{}", first_layer, last_layer)
 
-        layer_usage = self.active_model.get(int(layer))
-        if layer_usage is None:
-            logger.error("Failed to find filament usage for layer {}", layer)
+        usage = self.active_model.between(first_layer, last_layer)
+        if not usage:
+            logger.debug("No filament used in layers {}-{}", first_layer, last_layer)
             return
+        self._spend_filament(usage)
 
-        config = load_settings()
+    def _spend_filament(self, usage):
+        try:
+            config = load_settings()
+        except (OSError, ValueError) as e:
+            logger.error("Failed to load settings, not spending {}: {}", usage, e)
+            return
 
         trays = config.get("trays", {})
 
-        for filament, usage in layer_usage.items():
-            logger.debug("Spending {}mm of filament {}", usage, filament)
+        # Several filaments can be mapped to the same spool, settle each spool
+        # with a single request
+        spool_usage = {}
+        for filament, length in usage.items():
+            logger.debug("Spending {}mm of filament {}", length, filament)
 
             # Use the external spool ID if we're not using an AMS
             real_mapping = (
@@ -228,9 +505,22 @@ class FilamentUsageTracker:
             logger.debug(
                 "Spoolman spool for filament {} is {}", filament, spoolman_spool
             )
+            spool_usage[spoolman_spool] = spool_usage.get(spoolman_spool, 0) + length
+
+        # Spend the filament
+        for spoolman_spool, length in spool_usage.items():
+            try:
+                self.consumption.add(spoolman_spool, length)
+            except OSError as e:
+                logger.error(
+                    "Failed to journal {}mm spent from spool {}: {}",
+                    length,
+                    spoolman_spool,
+                    e,
+                )
 
-            # Spend the filament
-            self.spoolman_client.consume_spool(spoolman_spool, length=usage)
+    def _flush_consumption(self):
+        self.consumption.flush_soon()
 
     def _download_model(self, model_url):
         logger.debug("Downloading model from URL: {}", model_url)
@@ -250,47 +540,54 @@ class FilamentUsageTracker:
     def _retrieve_model_from_ftp(self, model_path):
         logger.debug("Retrieving model from FTP path: {}", model_path)
 
-        mount_prefixes = ("/sdcard/", "/media/usb0/")
-
-        # Remove fs mount prefixes
-        for p in mount_prefixes:
-            if model_path.startswith(p):
-                model_path = model_path.removeprefix(p)
-                break
-
         # Retrieve from FTP server
-        return retrieve_3mf(model_path)
+        return retrieve_3mf(_strip_mount_prefix(model_path))
 
-    def _load_model(self, model_path, gcode_file):
-        gcode = extract_gcode(model_path, gcode_file)
+    def _load_model(self, model, gcode_file, cancelled=None, on_slice_totals=None):
+        layer_usage = evaluate_model(model, gcode_file, cancelled, on_slice_totals)
 
-        if gcode is None:
+        if layer_usage is None and (cancelled is None or not cancelled.is_set()):
             logger.error("Failed to extract gcode from model")
-            return
-        self.active_model = evaluate_gcode(gcode)
-        logger.info("Model loaded successfully")
-
-        total_filament_usage = {}
-
-        for layer, layer_usage in self.active_model.items():
-            for filament, usage in layer_usage.items():
-                total_filament_usage[filament] = (
-                    total_filament_usage.get(filament, 0) + usage
-                )
-
-        for filament, usage in total_filament_usage.items():
-            logger.info("Filament {} usage: {}mm", filament, usage)
+        return layer_usage
 
     def _attempt_print_resume(self, task_id, subtask_id):
         result = recover_model(task_id, subtask_id)
         if result is None:
             return
-        model_path, gcode_file_name, current_layer, ams_mapping, using_ams = result
+        layer_usage, current_layer, ams_mapping, using_ams = result
 
         logger.info("Recovered model from checkpoint")
 
-        self._load_model(model_path, gcode_file_name)
-        self.spent_layers = set(range(current_layer + 1))
         self.ams_mapping = ams_mapping
-        self.current_layer = current_layer
         self.using_ams = using_ams
+
+        # The checkpoint holds the evaluated model, so it can be activated
+        # straight away
+        self._start_model_load(self._load_resumed_model, layer_usage, current_layer)
+
+    def _load_resumed_model(self, cancelled, layer_usage, layer):
+        with self._lock:
+            if not self._finish_model_load(cancelled, layer_usage):
+                return
+
+            self.spent_layers = set(range(layer + 1))
+            self.current_layer = layer
+            self._settle_pending_layers()
+
+
+def _slice_info_enabled():
+    return os.environ.get("BAMBU_SPOOLMAN_SLICE_INFO", "false").lower() == "true"
+
+
+def _partial_fetch_enabled():
+    return os.environ.get("BAMBU_SPOOLMAN_FTP_PARTIAL_FETCH", "false").lower() == "true"
+
+
+def _strip_mount_prefix(model_path):
+    mount_prefixes = ("/sdcard/", "/media/usb0/")
+
+    # Remove fs mount prefixes
+    for p in mount_prefixes:
+        if model_path.startswith(p):
+            return model_path.removeprefix(p)
+    return model_path
@@ -0,0 +1,140 @@
+import os
+import threading
+import zipfile
+
+from loguru import logger
+
+from bambu_spoolman.bambu_ftp import CACHE_DIRECTORY, list_3mf, open_3mf, retrieve_3mf
+from bambu_spoolman.gcode.bambu import evaluate_model
+from bambu_spoolman.gcode.model_index import index_key, load_model_index
+
+DEFAULT_INTERVAL = 30
+
+
+class _PrefetchedModel:
+    def __init__(self, size):
+        self.size = size
+        self.key = None  # Hash of the central directory, see index_key
+        # G-code path -> (layer usage, slicer totals)
+        self.plates = {}
+
+
+class ModelPrefetcher:
+    """
+    Evaluates the models in the printer's cache directory before they are
+    printed
+
+    The directory is polled over FTP. Every new 3mf is downloaded and the
+    G-code of each of its plates is evaluated, which also fills the usage
+    cache, so that a print of the model can be tracked as soon as it starts.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, directory=CACHE_DIRECTORY):
+        self.interval = interval
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        self._models = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="ModelPrefetcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def get(self, path, gcode_path=None):
+        """
+        Returns the evaluated usage and the slicer's totals of a prefetched
+        model, or None if it isn't ready
+
+        The central directory of the model on the printer is compared with the
+        prefetched one, so a model that was replaced since it was prefetched
+        isn't used, even if its size is unchanged.
+        """
+        if gcode_path is None:
+            return None
+
+        with self._lock:
+            model = self._models.get(path)
+        if model is None:
+            return None
+
+        result = model.plates.get(gcode_path.lstrip("/"))
+        if result is None:
+            return None
+
+        if self._current_key(path, model.size) != model.key:
+            logger.debug("Prefetched model {} has changed", path)
+            with self._lock:
+                # Prefetch it again on the next poll
+                if self._models.get(path) is model:
+                    del self._models[path]
+            return None
+        return result
+
+    def _current_key(self, path, size):
+        """
+        Returns the index key of a model on the printer, reading only its
+        central directory, or None if it has a different size
+        """
+        with open_3mf(path) as remote_file:
+            if remote_file is None or remote_file.size != size:
+                return None
+            with zipfile.ZipFile(remote_file) as zip_file:
+                return index_key(zip_file)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._poll()
+            except Exception as e:
+                logger.warning("Failed to prefetch models: {}", e)
+            self._stopped.wait(self.interval)
+
+    def _poll(self):
+        files = list_3mf(self.directory)
+
+        with self._lock:
+            # Forget about models that were removed from the printer
+            for path in list(self._models):
+                if path not in files:
+                    del self._models[path]
+            pending = [
+                (path, size)
+                for path, size in files.items()
+                if path not in self._models or self._models[path].size != size
+            ]
+
+        for path, size in pending:
+            if self._stopped.is_set():
+                return
+            self._prefetch(path, size)
+
+    def _prefetch(self, path, size):
+        logger.info("Prefetching model {}", path)
+        model = _PrefetchedModel(size)
+
+        local_path = retrieve_3mf(path)
+        if local_path is None:
+            return
+        try:
+            with zipfile.ZipFile(local_path) as zip_file:
+                model.key = index_key(zip_file)
+                plates = load_model_index(zip_file).plates.values()
+            for plate in plates:
+                layer_usage = evaluate_model(local_path, plate.gcode_path)
+                if layer_usage is not None:
+                    model.plates[plate.gcode_path] = (layer_usage, plate.slice_totals)
+        except zipfile.BadZipFile as e:
+            logger.warning("Could not prefetch model {}: {}", path, e)
+        finally:
+            os.remove(local_path)
+
+        with self._lock:
+            self._models[path] = model
+        logger.info("Prefetched {} plates of model {}", len(model.plates), path)
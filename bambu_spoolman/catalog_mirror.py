@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class CatalogMirror:
+    """
+    An in-memory copy of the vendors and filaments in Spoolman
+
+    Vendors are indexed by name and filaments by the id of the SpoolmanDB
+    filament they were created from, so auto-creating a spool can reuse them
+    without listing them first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vendors = {}
+        self._filaments = {}
+        self.refreshed_at = None  # Monotonic time of the last full refresh
+
+    def age(self):
+        """
+        Returns the number of seconds since the last full refresh
+        """
+        if self.refreshed_at is None:
+            return float("inf")
+        return time.monotonic() - self.refreshed_at
+
+    def replace(self, vendors, filaments):
+        """
+        Replaces the contents of the mirror with full listings of vendors and
+        filaments
+        """
+        with self._lock:
+            self._vendors = {}
+            self._filaments = {}
+            # When a name or external id is shared, the first one listed wins
+            for vendor in vendors:
+                self._vendors.setdefault(vendor.get("name"), vendor)
+            for filament in filaments:
+                if external_id := filament.get("external_id"):
+                    self._filaments.setdefault(external_id, filament)
+            self.refreshed_at = time.monotonic()
+
+    def add_vendor(self, vendor):
+        with self._lock:
+            self._vendors[vendor.get("name")] = vendor
+
+    def add_filament(self, filament):
+        if external_id := filament.get("external_id"):
+            with self._lock:
+                self._filaments[external_id] = filament
+
+    def remove_filament(self, filament):
+        if external_id := filament.get("external_id"):
+            with self._lock:
+                if self._filaments.get(external_id, {}).get("id") == filament["id"]:
+                    del self._filaments[external_id]
+
+    def vendor(self, name):
+        with self._lock:
+            return self._vendors.get(name)
+
+    def filament(self, external_id):
+        with self._lock:
+            return self._filaments.get(external_id)
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import requests
+from loguru import logger
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a dependency after it failed ``failure_threshold`` times in
+    a row, so callers fail fast instead of waiting on it
+
+    Once ``reset_timeout`` seconds have passed, a single call is let through as
+    a probe. If it succeeds the breaker closes again, otherwise it stays open
+    for another ``reset_timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None  # Monotonic time the breaker last opened
+        self._probing = False
+        self.succeeded_at = None  # Monotonic time of the last successful call
+
+    @property
+    def open(self):
+        """
+        Whether calls are currently being refused
+        """
+        with self._lock:
+            return self._opened_at is not None and (
+                self._probing or time.monotonic() - self._opened_at < self.reset_timeout
+            )
+
+    def acquire(self):
+        """
+        Checks whether a call may be made, raising CircuitOpenError if not
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    f"{self.name} is unavailable, not trying again yet"
+                )
+            logger.info("Checking whether {} has recovered", self.name)
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("{} has recovered", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            self.succeeded_at = time.monotonic()
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (
+                self._opened_at is None and self._failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    "{} failed {} times in a row, pausing calls for {}s",
+                    self.name,
+                    self._failures,
+                    self.reset_timeout,
+                )
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self):
+        """
+        Ends a call that says nothing about the health of the dependency
+        """
+        with self._lock:
+            self._probing = False
@@ -0,0 +1,81 @@
+import math
+
+# Reference white of the D65 illuminant
+_WHITE = (0.95047, 1.0, 1.08883)
+
+
+def hex_to_lab(color_hex):
+    """
+    Converts an sRGB color hex (RRGGBB) to CIELAB, or returns None if it isn't
+    a valid color
+    """
+    if not isinstance(color_hex, str) or len(color_hex) < 6:
+        return None
+    try:
+        rgb = [int(color_hex[i : i + 2], 16) / 255 for i in (0, 2, 4)]
+    except ValueError:
+        return None
+
+    r, g, b = (c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4 for c in rgb)
+    xyz = (
+        (0.4124 * r + 0.3576 * g + 0.1805 * b) / _WHITE[0],
+        (0.2126 * r + 0.7152 * g + 0.0722 * b) / _WHITE[1],
+        (0.0193 * r + 0.1192 * g + 0.9505 * b) / _WHITE[2],
+    )
+    fx, fy, fz = (
+        t ** (1 / 3) if t > 216 / 24389 else (24389 / 27 * t + 16) / 116 for t in xyz
+    )
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+
+class ColorIndex:
+    """
+    A k-d tree of CIELAB colors for finding the colors closest to another one
+
+    Distances are CIE76 color differences, where a difference of about 2.3 is
+    just noticeable.
+    """
+
+    def __init__(self, entries):
+        """
+        Builds the tree from (Lab color, value) pairs
+        """
+        self._root = self._build(list(entries), 0)
+
+    def within(self, color, distance):
+        """
+        Returns (distance, value) pairs of the colors at most ``distance`` from
+        ``color``, closest first
+        """
+        found = []
+        self._search(self._root, color, distance, found)
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def _build(self, entries, axis):
+        if not entries:
+            return None
+        entries.sort(key=lambda entry: entry[0][axis])
+        middle = len(entries) // 2
+        next_axis = (axis + 1) % 3
+        return (
+            entries[middle],
+            axis,
+            self._build(entries[:middle], next_axis),
+            self._build(entries[middle + 1 :], next_axis),
+        )
+
+    def _search(self, node, color, distance, found):
+        while node is not None:
+            (point, value), axis, left, right = node
+            d = math.dist(point, color)
+            if d <= distance:
+                found.append((d, value))
+
+            offset = color[axis] - point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            # Only descend into the far side if the search sphere crosses the
+            # splitting plane
+            if abs(offset) <= distance:
+                self._search(far, color, distance, found)
+            node = near
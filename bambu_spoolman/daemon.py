@@ -5,10 +5,21 @@ import os
 from dotenv import load_dotenv
 from loguru import logger
 
+from bambu_spoolman import metrics
 from bambu_spoolman.bambu_mqtt import MqttHandler, stateful_printer_info
 from bambu_spoolman.broker.automatic_spool_switch import AutomaticSpoolSwitch
+from bambu_spoolman.broker.consumption_aggregator import (
+    DEFAULT_INTERVAL as DEFAULT_CONSUME_INTERVAL,
+)
+from bambu_spoolman.broker.consumption_aggregator import (
+    DEFAULT_THRESHOLD_MM,
+    ConsumptionAggregator,
+)
+from bambu_spoolman.broker.consumption_journal import ConsumptionJournal
 from bambu_spoolman.broker.filament_usage_tracker import FilamentUsageTracker
+from bambu_spoolman.broker.model_prefetcher import DEFAULT_INTERVAL, ModelPrefetcher
 from bambu_spoolman.grpc.server import serve as run_grpc_server
+from bambu_spoolman.spoolman import instance as spoolman_instance
 
 
 async def async_main():
@@ -27,17 +38,55 @@ async def async_main():
     mqtt.add_on_connect_callback(stateful_printer_info.on_connect)
     mqtt.add_on_disconnect_callback(stateful_printer_info.on_disconnect)
 
-    usage_tracker = FilamentUsageTracker()
+    prefetcher = None
+    if os.environ.get("BAMBU_SPOOLMAN_PREFETCH", "false").lower() == "true":
+        logger.info("Enabling model prefetching")
+        prefetcher = ModelPrefetcher(
+            interval=float(
+                os.environ.get("BAMBU_SPOOLMAN_PREFETCH_INTERVAL", DEFAULT_INTERVAL)
+            )
+        )
+        prefetcher.start()
+
+    if os.environ.get("SPOOLMAN_CHANGE_FEED", "false").lower() == "true":
+        logger.info("Watching Spoolman for changes")
+        spoolman_instance().start_change_feed()
+
+    consumption = ConsumptionAggregator(
+        spoolman_instance(),
+        interval=float(
+            os.environ.get("BAMBU_SPOOLMAN_CONSUME_INTERVAL", DEFAULT_CONSUME_INTERVAL)
+        ),
+        threshold=float(
+            os.environ.get("BAMBU_SPOOLMAN_CONSUME_THRESHOLD_MM", DEFAULT_THRESHOLD_MM)
+        ),
+        journal=ConsumptionJournal(),
+    )
+    consumption.start()
+
+    usage_tracker = FilamentUsageTracker(consumption, prefetcher)
     mqtt.add_callback(usage_tracker.on_message)
 
     if os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME") is not None:
         logger.info("Enabling automatic spool switching")
-        mqtt.add_callback(AutomaticSpoolSwitch.get_instance().on_message)
+        switch = AutomaticSpoolSwitch.get_instance()
+        mqtt.add_callback(switch.on_message)
+        if switch.auto_create_enabled:
+            spoolman_instance().preload_external_filaments()
+
+    metrics_interval = float(os.environ.get("BAMBU_SPOOLMAN_METRICS_INTERVAL", "3600"))
+    if metrics_interval > 0:
+        metrics.start_reporting(metrics_interval)
 
     mqtt.start()
 
-    await asyncio.gather(*tasks)
-    mqtt.join()
+    try:
+        await asyncio.gather(*tasks)
+        mqtt.join()
+    finally:
+        # Don't lose the filament spent since the last batch
+        consumption.stop()
+        metrics.report()
 
 
 def main():
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+from bambu_spoolman.settings import get_configuration_path
+
+CACHE_FILE = "external_filaments.json"
+
+DEFAULT_TTL = 3600
+
+
+class ExternalFilamentCache:
+    """
+    A copy of the external filaments from SpoolmanDB, persisted in the
+    configuration directory
+
+    The copy is loaded from disk on first use. Once it is older than ``ttl``
+    seconds it is revalidated in the background with the ETag or
+    Last-Modified date of the last response, falling back to comparing a hash
+    of its contents, so an unchanged listing is neither parsed nor stored
+    again. Only the very first download, when no copy exists, blocks.
+    """
+
+    def __init__(self, fetch, path=None, ttl=DEFAULT_TTL):
+        self.fetch = fetch  # Sends a GET of the listing with the given headers
+        self.path = path or get_configuration_path(CACHE_FILE)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._loaded = False
+        self._filaments = None
+        self._validators = {}  # etag, last_modified and hash of the listing
+        self._fetched_at = None
+
+    def get(self):
+        """
+        Returns the cached filaments, refreshing them in the background if they
+        are stale
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+        if self._filaments is None:
+            self.refresh()
+            return self._filaments or []
+
+        if time.time() - self._fetched_at >= self.ttl:
+            self.refresh_in_background()
+        return self._filaments
+
+    def preload(self):
+        """
+        Loads the cached filaments, or downloads them if there are none, in
+        the background
+        """
+        threading.Thread(
+            target=self.get, name="ExternalFilamentPreload", daemon=True
+        ).start()
+
+    def refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(
+            target=self.refresh, name="ExternalFilamentRefresh", daemon=True
+        ).start()
+
+    def refresh(self):
+        """
+        Revalidates the cached filaments with SpoolmanDB
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            # Another refresh is in progress, wait for it instead
+            with self._refresh_lock:
+                return
+        try:
+            self._refresh()
+        except Exception as e:
+            logger.error(f"Exception getting external filaments: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        headers = {}
+        if self._filaments is not None:
+            if etag := self._validators.get("etag"):
+                headers["If-None-Match"] = etag
+            if last_modified := self._validators.get("last_modified"):
+                headers["If-Modified-Since"] = last_modified
+
+        logger.info("Fetching external filaments from SpoolmanDB...")
+        response = self.fetch(headers=headers)
+        if response.status_code == 304:
+            logger.info("External filaments have not changed")
+            self._touch()
+            return
+        response.raise_for_status()
+
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "hash": hashlib.sha256(response.content).hexdigest(),
+        }
+        if self._filaments is not None and validators["hash"] == self._validators.get(
+            "hash"
+        ):
+            logger.info("External filaments have not changed")
+            self._validators = validators
+            self._touch()
+            return
+
+        filaments = response.json()
+        self._save(filaments, validators)
+        self._filaments = filaments
+        self._validators = validators
+        self._fetched_at = time.time()
+        logger.info(f"Cached {len(filaments)} external filaments")
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            fetched_at = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Discarding unreadable external filament cache: {}", e)
+            return
+
+        self._filaments = data["filaments"]
+        self._validators = data["validators"]
+        self._fetched_at = fetched_at
+        logger.debug(
+            "Loaded {} external filaments ({}s old)",
+            len(self._filaments),
+            int(time.time() - fetched_at),
+        )
+
+    def _save(self, filaments, validators):
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({"validators": validators, "filaments": filaments}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not save external filament cache: {}", e)
+
+    def _touch(self):
+        """
+        Marks the cached filaments as fresh
+        """
+        self._fetched_at = time.time()
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
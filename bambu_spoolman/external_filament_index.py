@@ -0,0 +1,196 @@
+from loguru import logger
+
+from bambu_spoolman.color_index import ColorIndex, hex_to_lab
+
+
+class _Candidate:
+    def __init__(self, position, filament):
+        self.position = position  # Position in the SpoolmanDB listing
+        self.filament = filament
+        self.id = filament.get("id", "").lower()
+        self.material = filament.get("material", "").upper()
+
+
+class ExternalFilamentIndex:
+    """
+    An index of the external filaments from SpoolmanDB for matching them to
+    AMS trays
+
+    Filaments are grouped by normalised manufacturer and color hex when the
+    index is built, so a match only looks at the handful of filaments of the
+    tray's manufacturer and colors.
+
+    If ``color_distance`` is set, the colors of the Bambu Lab filaments of each
+    material are also indexed in CIELAB space. A tray whose colors match no
+    filament exactly is then matched to the filaments of its material whose
+    colors are closest, up to that distance.
+    """
+
+    def __init__(self, filaments, color_distance=None):
+        self.filaments = filaments  # The listing the index was built from
+        self.color_distance = color_distance
+
+        self._by_color = {}  # (manufacturer, color hex) -> [_Candidate]
+        self._bambu_manufacturers = set()
+        for position, filament in enumerate(filaments):
+            manufacturer = manufacturer_name(filament).lower()
+            if "bambu" in manufacturer:
+                self._bambu_manufacturers.add(manufacturer)
+
+            candidate = _Candidate(position, filament)
+            for color in set(filament_colors(filament)):
+                self._by_color.setdefault((manufacturer, color), []).append(candidate)
+
+        self._by_material = {}  # Material -> ColorIndex of Bambu Lab filaments
+        if color_distance is not None:
+            self._build_color_indexes()
+
+    def _build_color_indexes(self):
+        entries = {}
+        for position, filament in enumerate(self.filaments):
+            if "bambu" not in manufacturer_name(filament).lower():
+                continue
+            candidate = _Candidate(position, filament)
+            for color in set(filament_colors(filament)):
+                if (lab := hex_to_lab(color)) is not None:
+                    entries.setdefault(candidate.material, []).append((lab, candidate))
+
+        self._by_material = {
+            material: ColorIndex(material_entries)
+            for material, material_entries in entries.items()
+        }
+
+    def match(self, tray_data):
+        """
+        Finds the Bambu Lab filament matching a tray
+        Steps:
+        1. Filter by Bambu Lab manufacturer/vendor and any of the tray's colors
+        2. Try to match by sub_brand with various separators (underscore, plus, hyphen)
+        3. Fall back to material type matching
+        Returns the best match or None
+        """
+        filament_type = tray_data.get("tray_type", "")
+        filament_sub_brand = tray_data.get("tray_sub_brands", "")
+        color_hexes = tray_colors(tray_data)
+
+        if not self._bambu_manufacturers:
+            logger.debug("No Bambu Lab filaments found in external database")
+            return None
+
+        candidates = {}
+        for manufacturer in self._bambu_manufacturers:
+            for color in color_hexes:
+                for candidate in self._by_color.get((manufacturer, color), []):
+                    candidates[candidate.position] = candidate
+        # Keep the order of the SpoolmanDB listing
+        color_matched = [candidates[position] for position in sorted(candidates)]
+
+        if not color_matched:
+            color_matched = self._nearest_colors(color_hexes, filament_type)
+            if not color_matched:
+                logger.debug("No color match found for {}", color_hexes)
+                return None
+
+        # Try to match by sub_brand/specific name (e.g., "PETG HF")
+        if filament_sub_brand and filament_sub_brand.strip():
+            sub_brands = [
+                filament_sub_brand.replace(" ", "_").lower(),
+                filament_sub_brand.replace(" ", "+").lower(),
+                filament_sub_brand.replace(" ", "-").lower(),
+            ]
+
+            for candidate in color_matched:
+                for brand in sub_brands:
+                    if brand in candidate.id:
+                        logger.info(
+                            "Found exact sub-brand match: {} (id: {})",
+                            candidate.filament.get("name"),
+                            candidate.id,
+                        )
+                        return candidate.filament
+
+        # Filter by material type (fallback)
+        material = filament_type.upper()
+        for candidate in color_matched:
+            if candidate.material == material:
+                logger.info(
+                    "Found material type match: {} (id: {})",
+                    candidate.filament.get("name"),
+                    candidate.filament.get("id"),
+                )
+                return candidate.filament
+
+        logger.debug(
+            "No external filament match for {} ({}) with color {}",
+            filament_sub_brand,
+            filament_type,
+            color_hexes,
+        )
+        return None
+
+    def _nearest_colors(self, color_hexes, filament_type):
+        """
+        Returns the filaments of a material whose colors are within the color
+        distance of any of the given colors, closest first
+        """
+        index = self._by_material.get(filament_type.upper())
+        if index is None:
+            return []
+
+        distances = {}
+        for color in color_hexes:
+            if (lab := hex_to_lab(color)) is None:
+                continue
+            for distance, candidate in index.within(lab, self.color_distance):
+                previous = distances.get(candidate.position)
+                if previous is None or distance < previous[0]:
+                    distances[candidate.position] = (distance, candidate)
+
+        nearest = sorted(distances.values(), key=lambda item: item[0])
+        if nearest:
+            logger.debug(
+                "No exact color match for {}, closest color is {:.1f} away",
+                color_hexes,
+                nearest[0][0],
+            )
+        return [candidate for _, candidate in nearest]
+
+
+def manufacturer_name(filament):
+    """
+    Returns the manufacturer of an external filament, which is either a name
+    or an object with a name
+    """
+    manufacturer = filament.get("manufacturer", "")
+    if isinstance(manufacturer, dict):
+        return manufacturer.get("name", "")
+    elif isinstance(manufacturer, str):
+        return manufacturer
+    return ""
+
+
+def filament_colors(filament):
+    """
+    Returns the upper case color hexes of an external filament
+    """
+    # Handle both color_hex (single) and color_hexes (multiple)
+    colors = filament.get("color_hex") or filament.get("color_hexes")
+    if isinstance(colors, str):
+        colors = [colors]
+    elif colors is None:
+        colors = []
+    return [color.upper() for color in colors]
+
+
+def tray_colors(tray_data):
+    """
+    Returns the upper case color hexes of the filament in a tray, without alpha
+    """
+    # Extract colors from cols array (supports multi-color filaments)
+    cols = tray_data.get("cols", [])
+    if cols:
+        return [col[:6].upper() for col in cols]
+
+    # Fall back to tray_color for backwards compatibility
+    tray_color = tray_data.get("tray_color", "")
+    return [tray_color[:6].upper()] if tray_color else []
@@ -1,44 +1,223 @@
+import io
 import os
-import shutil
-import tempfile
-import xml.etree.ElementTree as ET
 import zipfile
 
 from loguru import logger
 
+from bambu_spoolman.gcode.cache import cache_key, load_usage, save_usage
+from bambu_spoolman.gcode.model_index import (
+    MODEL_SETTINGS_PATH,
+    default_plate_gcode,
+    load_model_index,
+    plate_number,
+)
+from bambu_spoolman.gcode.parser import (
+    PARALLEL_MIN_SIZE,
+    evaluate_gcode,
+    evaluate_gcode_parallel,
+)
+from bambu_spoolman.gcode.slice_info import (
+    SLICE_INFO_PATH,
+    parse_slice_info,
+    plate_totals,
+)
+from bambu_spoolman.gcode.stream import Pipe, iter_zip_members, start_stage
 
-def extract_gcode(path, gcode_path=None):
-    logger.debug(f"Extracting GCODE from {path}")
-    with tempfile.TemporaryDirectory() as temp_folder:
-        logger.debug("Extracting {} to {}", path, temp_folder)
-        with zipfile.ZipFile(path, "r") as zip_ref:
-            zip_ref.extractall(temp_folder)
 
-        # Find the GCODE file
+def _gcode_workers():
+    return int(os.environ.get("BAMBU_SPOOLMAN_GCODE_WORKERS", "1"))
+
+
+def _evaluate(gcode, size, cancelled):
+    workers = _gcode_workers()
+    if workers > 1 and size >= PARALLEL_MIN_SIZE:
+        return evaluate_gcode_parallel(gcode, workers, cancelled=cancelled)
+    return evaluate_gcode(gcode, cancelled)
+
+
+def evaluate_model(path, gcode_path=None, cancelled=None, on_slice_totals=None):
+    """
+    Evaluates the filament usage per layer of the G-code inside a 3MF model
+
+    The plate is looked up in the model's index, which is only built from the
+    model's metadata the first time the model is seen. A ``gcode_path`` that
+    isn't the G-code of a plate is read from the archive directly. Previously evaluated
+    G-code is served from the usage cache. Otherwise only the G-code member is
+    read from the archive, and it is decompressed on the fly as it is
+    evaluated. Returns None if the G-code could not be found or the
+    ``cancelled`` event was set.
+
+    If given, ``on_slice_totals`` is called with the slicer's totals of the
+    plate before the G-code is evaluated.
+    """
+    logger.debug(f"Evaluating GCODE in {path}")
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        plate = load_model_index(zip_ref).plate(gcode_path)
+        if plate is not None:
+            gcode_path = plate.gcode_path
+        elif gcode_path is not None:
+            # Not the G-code of a plate, but it may still be in the archive
+            gcode_path = gcode_path.lstrip("/")
+
+        try:
+            gcode_info = zip_ref.getinfo(gcode_path)
+        except KeyError:
+            logger.error(f"GCODE file {gcode_path} does not exist in model")
+            return None
+        logger.debug(f"Found GCODE file at {gcode_path} ({gcode_info.file_size} bytes)")
+
+        if (
+            on_slice_totals is not None
+            and plate is not None
+            and plate.slice_totals is not None
+        ):
+            on_slice_totals(plate.slice_totals)
+
+        key = cache_key(gcode_info)
+        layer_usage = load_usage(key)
+        if layer_usage is not None:
+            logger.info("Loaded filament usage from cache")
+            return layer_usage
+
+        with zip_ref.open(gcode_info) as gcode:
+            layer_usage = _evaluate(gcode, gcode_info.file_size, cancelled)
+
+    if layer_usage is None:
+        return None
+    save_usage(key, layer_usage)
+    return layer_usage
+
+
+def evaluate_model_stream(
+    produce, gcode_path=None, cancelled=None, on_slice_totals=None
+):
+    """
+    Evaluates the filament usage per layer of a 3MF model while it is being
+    transferred
+
+    ``produce(write)`` is called on its own thread and passes the raw model to
+    ``write`` in chunks, e.g. from an FTP or HTTP transfer. The archive is read
+    sequentially from its local headers, the G-code member is decompressed on
+    a second thread and evaluated on the calling thread, with bounded buffers
+    between the three stages.
+
+    Without a known ``gcode_path`` the G-code of the plate selected in the
+    model settings is evaluated, as in :func:`evaluate_model`. The settings
+    may come after the G-code in the archive, so until they are read every
+    plate's G-code is evaluated as it streams past. Sliced models usually
+    only hold the G-code of the plate being printed.
+    Returns None if the G-code could not be found or the ``cancelled`` event
+    was set. Raises ``zipfile.BadZipFile`` if the archive can't be streamed.
+
+    If given, ``on_slice_totals`` is called with the slicer's totals of the
+    plate as soon as they have been transferred, which may be before or after
+    the G-code.
+    """
+    download = Pipe()
+    download_stage = start_stage("ModelDownload", produce, download)
+
+    if gcode_path is not None:
+        gcode_path = gcode_path.lstrip("/")
+
+    slice_info = None
+    layer_usage = None
+    found = False
+    # G-code path -> usage of the plates evaluated before the model settings
+    # said which one is printed
+    candidates = {}
+    try:
+        for member in iter_zip_members(download):
+            if cancelled is not None and cancelled.is_set():
+                return None
+
+            if on_slice_totals is not None and member.filename == SLICE_INFO_PATH:
+                chunks = []
+                member.decompress_into(chunks.append)
+                slice_info = parse_slice_info(io.BytesIO(b"".join(chunks)))
+            elif gcode_path is None and member.filename == MODEL_SETTINGS_PATH:
+                chunks = []
+                member.decompress_into(chunks.append)
+                gcode_path = default_plate_gcode(io.BytesIO(b"".join(chunks)))
+                if gcode_path is None:
+                    logger.error("No plate with G-code in the model settings")
+                    return None
+                logger.debug(f"Model settings select {gcode_path}")
+                if gcode_path in candidates:
+                    found = True
+                    layer_usage = candidates[gcode_path]
+            elif not found and _is_gcode_member(member.filename, gcode_path):
+                logger.debug(f"Found GCODE file at {member.filename}")
+                usage = _evaluate_member(member, cancelled, download)
+                if usage is None:
+                    return None
+                if gcode_path is None:
+                    candidates[member.filename] = usage
+                else:
+                    found = True
+                    layer_usage = usage
+
+            if (
+                on_slice_totals is not None
+                and slice_info is not None
+                and gcode_path is not None
+            ):
+                _report_slice_totals(slice_info, gcode_path, on_slice_totals)
+                on_slice_totals = None
+
+            if found and on_slice_totals is None:
+                return layer_usage
 
         if gcode_path is None:
-            model_settings_path = os.path.join(
-                temp_folder, "Metadata", "model_settings.config"
-            )
-            logger.debug(f"Looking for GCODE in {model_settings_path}")
-
-            root = ET.parse(model_settings_path).getroot()
-            plate = root[0]
-            for item in plate:
-                if item.attrib["key"] == "gcode_file":
-                    gcode_path = os.path.join(temp_folder, item.attrib["value"])
-                    break
-
-            if gcode_path is None:
-                logger.error("Could not find GCODE file")
-                return
-        else:
-            gcode_path = os.path.join(temp_folder, gcode_path)
-
-        logger.debug(f"Found GCODE file at {gcode_path}")
-        with open(gcode_path, "r") as f:
-            gcode = f.read()
-            logger.debug(f"Read {len(gcode)} bytes of GCODE")
-            # Delete the temp folder
-            shutil.rmtree(temp_folder)
-            return gcode
+            logger.error(f"Could not find {MODEL_SETTINGS_PATH} in model")
+            return None
+        if not found:
+            logger.error(f"GCODE file {gcode_path} does not exist in model")
+            return None
+        return layer_usage
+    finally:
+        # Stop the transfer if it's still running
+        download.close()
+        download_stage.join()
+
+
+def _is_gcode_member(filename, gcode_path):
+    if gcode_path is None:
+        return plate_number(filename) is not None
+    return filename == gcode_path
+
+
+def _report_slice_totals(slice_info, gcode_path, on_slice_totals):
+    slice_totals = plate_totals(slice_info, gcode_path)
+    if slice_totals is not None:
+        on_slice_totals(slice_totals)
+
+
+def _evaluate_member(member, cancelled, download):
+    key = None
+    if not member.has_data_descriptor:
+        key = cache_key(member)
+        layer_usage = load_usage(key)
+        if layer_usage is not None:
+            logger.info("Loaded filament usage from cache")
+            return layer_usage
+
+    gcode = Pipe()
+    inflate_stage = start_stage("ModelInflate", member.decompress_into, gcode)
+    layer_usage = None
+    try:
+        layer_usage = _evaluate(gcode, member.file_size, cancelled)
+    finally:
+        gcode.close()
+        if layer_usage is None:
+            # The rest of the archive won't be read, so stop the transfer as
+            # well rather than waiting for its next chunk
+            download.close()
+        inflate_stage.join()
+
+    if layer_usage is None:
+        return None
+    if key is None:
+        # The CRC and size are known now that the data descriptor was read
+        key = cache_key(member)
+    save_usage(key, layer_usage)
+    return layer_usage
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+from loguru import logger
+
+from bambu_spoolman.settings import get_configuration_path
+
+# Bump whenever the evaluator changes in a way that changes its results
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE_MB = 64
+
+
+def cache_directory():
+    path = get_configuration_path("cache")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def _max_cache_size():
+    size_mb = os.environ.get("BAMBU_SPOOLMAN_CACHE_SIZE_MB", DEFAULT_CACHE_SIZE_MB)
+    return int(float(size_mb) * 1024 * 1024)
+
+
+def cache_key(gcode_info):
+    """
+    Computes the cache key of a G-code member of a 3MF
+
+    The key is derived from the member name (which identifies the plate) and
+    the CRC32 and size recorded for it in the archive, so it is available
+    before any of the G-code has been read.
+    """
+    key = ":".join(
+        (
+            str(CACHE_VERSION),
+            gcode_info.filename,
+            f"{gcode_info.CRC:08x}",
+            str(gcode_info.file_size),
+        )
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _entry_path(key, suffix=".json"):
+    return os.path.join(cache_directory(), f"{key}{suffix}")
+
+
+def _load_entry(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Discarding unreadable cache entry {}: {}", path, e)
+        _remove(path)
+        return None
+
+    # Mark the entry as recently used
+    os.utime(path)
+    return data
+
+
+def _save_entry(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+    _evict()
+
+
+def load_usage(key):
+    """
+    Loads the evaluated usage per layer for the given key, or None on a miss
+    """
+    data = _load_entry(_entry_path(key))
+    if data is None:
+        return None
+
+    logger.debug("Usage cache hit for {}", key)
+    return {
+        int(layer): {int(filament): usage for filament, usage in usage.items()}
+        for layer, usage in data.items()
+    }
+
+
+def save_usage(key, layer_usage):
+    """
+    Stores the evaluated usage per layer and evicts the least recently used
+    entries once the cache grows beyond its size limit
+    """
+    _save_entry(_entry_path(key), layer_usage)
+    logger.debug("Saved usage for {} to cache", key)
+
+
+def load_index(key):
+    """
+    Loads the model index stored for the given key, or None on a miss
+    """
+    return _load_entry(_entry_path(key, ".index.json"))
+
+
+def save_index(key, index):
+    """
+    Stores a model index, which shares the size limit of the usage cache
+    """
+    _save_entry(_entry_path(key, ".index.json"), index)
+    logger.debug("Saved model index {} to cache", key)
+
+
+def _evict():
+    max_size = _max_cache_size()
+    directory = cache_directory()
+
+    entries = []
+    total_size = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= max_size:
+            break
+        logger.debug("Evicting {} from usage cache", path)
+        _remove(path)
+        total_size -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
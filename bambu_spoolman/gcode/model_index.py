@@ -0,0 +1,173 @@
+import hashlib
+import re
+import xml.etree.ElementTree as ET
+
+from loguru import logger
+
+from bambu_spoolman.gcode.cache import load_index, save_index
+from bambu_spoolman.gcode.slice_info import SLICE_INFO_PATH, parse_slice_info
+
+# Bump whenever the contents of the index change
+INDEX_VERSION = 2
+
+MODEL_SETTINGS_PATH = "Metadata/model_settings.config"
+
+_PLATE_GCODE_RE = re.compile(r"Metadata/plate_(\d+)\.gcode")
+
+
+class Plate:
+    """
+    A plate of a 3MF model and the archive member of its G-code
+    """
+
+    def __init__(self, number, gcode_path, slice_totals):
+        self.number = number
+        self.gcode_path = gcode_path
+        self.slice_totals = slice_totals  # The slicer's totals, or None
+
+    def as_dict(self):
+        return {
+            "number": self.number,
+            "gcode_path": self.gcode_path,
+            "slice_totals": self.slice_totals,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        slice_totals = data["slice_totals"]
+        if slice_totals is not None:
+            slice_totals = {
+                int(filament): usage for filament, usage in slice_totals.items()
+            }
+        return cls(data["number"], data["gcode_path"], slice_totals)
+
+
+class ModelIndex:
+    """
+    The plates of a 3MF model
+
+    Built once per model from its model settings, slice info and central
+    directory, and persisted next to the usage cache under a hash of the
+    central directory. Selecting a plate of a known model then needs neither
+    of the metadata files.
+    """
+
+    def __init__(self, plates, default_plate=None):
+        self.plates = plates  # G-code path -> Plate, in plate order
+        self.default_plate = default_plate
+
+    def plate(self, gcode_path=None):
+        """
+        Returns the plate whose G-code is at ``gcode_path``, or the plate
+        selected in the model settings if no path is given
+        """
+        if gcode_path is None:
+            gcode_path = self.default_plate
+            if gcode_path is None:
+                return None
+        return self.plates.get(gcode_path.lstrip("/"))
+
+    def as_dict(self):
+        return {
+            "version": INDEX_VERSION,
+            "default_plate": self.default_plate,
+            "plates": [plate.as_dict() for plate in self.plates.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        plates = [Plate.from_dict(plate) for plate in data["plates"]]
+        return cls({plate.gcode_path: plate for plate in plates}, data["default_plate"])
+
+
+def index_key(zip_file):
+    """
+    Computes the key of a model's index from its central directory
+
+    The central directory records the name, CRC, sizes and offset of every
+    member, so it identifies the whole archive without reading it.
+    """
+    digest = hashlib.sha256(str(INDEX_VERSION).encode())
+    for info in zip_file.infolist():
+        digest.update(
+            f"{info.filename}:{info.CRC:08x}:{info.compress_size}:"
+            f"{info.file_size}:{info.header_offset}\n".encode()
+        )
+    return digest.hexdigest()
+
+
+def load_model_index(zip_file):
+    """
+    Returns the index of a 3MF model, building and persisting it if the model
+    hasn't been seen before
+    """
+    key = index_key(zip_file)
+    data = load_index(key)
+    if data is not None and data.get("version") == INDEX_VERSION:
+        logger.debug("Loaded model index {}", key)
+        return ModelIndex.from_dict(data)
+
+    index = build_model_index(zip_file)
+    save_index(key, index.as_dict())
+    return index
+
+
+def build_model_index(zip_file):
+    """
+    Builds the index of a 3MF model from its metadata files
+    """
+    logger.debug("Building model index")
+    slice_info = {}
+    try:
+        with zip_file.open(SLICE_INFO_PATH) as f:
+            slice_info = parse_slice_info(f)
+    except KeyError:
+        logger.debug("Could not find {} in model", SLICE_INFO_PATH)
+
+    members = [
+        (number, info)
+        for info in zip_file.infolist()
+        if (number := plate_number(info.filename)) is not None
+    ]
+
+    plates = {}
+    for number, info in sorted(members, key=lambda member: member[0]):
+        plates[info.filename] = Plate(number, info.filename, slice_info.get(number))
+
+    return ModelIndex(plates, _find_default_plate(zip_file))
+
+
+def plate_number(filename):
+    """
+    Returns the number of the plate whose G-code is at ``filename``, or None
+    if it isn't the G-code of a plate
+    """
+    match = _PLATE_GCODE_RE.fullmatch(filename)
+    return int(match.group(1)) if match else None
+
+
+def _find_default_plate(zip_file):
+    """
+    Finds the G-code of the first plate in the model settings that has one
+    """
+    try:
+        model_settings = zip_file.open(MODEL_SETTINGS_PATH)
+    except KeyError:
+        logger.error("Could not find {} in model", MODEL_SETTINGS_PATH)
+        return None
+
+    with model_settings:
+        return default_plate_gcode(model_settings)
+
+
+def default_plate_gcode(model_settings):
+    """
+    Returns the G-code path of the first plate in the model settings file
+    that has one, or None
+    """
+    root = ET.parse(model_settings).getroot()
+    for plate in root.iter("plate"):
+        for item in plate.iter("metadata"):
+            if item.attrib.get("key") == "gcode_file" and item.attrib.get("value"):
+                return item.attrib["value"].lstrip("/")
+    return None
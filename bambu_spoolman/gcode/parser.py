@@ -1,93 +1,126 @@
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
 from loguru import logger
 
+# Size of the blocks read from file-like G-code sources
+READ_CHUNK_SIZE = 1024 * 1024
 
-class GCodeOperation:
-    def __init__(self, raw_line):
-        self.operation = None
-        self.params = {}
-        self.comment = None
+# Approximate size of the segments evaluated by each worker in parallel mode
+PARALLEL_SEGMENT_SIZE = 8 * 1024 * 1024
 
-        self._parse(raw_line)
+# G-code smaller than this is always evaluated serially, as starting the worker
+# processes would cost more than it saves
+PARALLEL_MIN_SIZE = 4 * PARALLEL_SEGMENT_SIZE
 
-    def _parse(self, raw_line):
-        # Split the line into operation and comment
-        parts = list(map(lambda x: x.strip(), raw_line.split(";")))
-        if len(parts) > 1:
-            self.comment = parts[1].strip()
+# Matches the only three kinds of lines that affect filament usage. Everything
+# else (comments, travel moves, temperatures, ...) is skipped by the regex
+# engine without ever reaching Python code.
+#
+# The operation has to be the first word on the line and is terminated by
+# whitespace, a comment or the end of the line, so that e.g. G10 or M620.1 are
+# not mistaken for G1 or M620. For extrusion moves the greedy match picks the
+# last E word on the line, mirroring a dict of parameters where later words
+# overwrite earlier ones.
+_OPERATION_RE = re.compile(
+    rb"^[ \t\r\f\v]*(?:"
+    rb"M73(?=[\s;]|$)(?P<m73>[^;\n]*)"
+    rb"|M620(?=[\s;]|$)(?P<m620>[^;\n]*)"
+    rb"|G[0-3](?=[\s;]|$)[^;\n]*[ \t\r\f\v]E(?P<extrusion>[^\s;]*)"
+    rb")",
+    re.MULTILINE,
+)
 
-        # Split the operation into parts
-        parts = re.split(r"\s+", parts[0])
-        self.operation = parts[0]
-        for part in parts[1:]:
-            key = part[0]
-            value = part[1:]
-            self.params[key] = value
+_FULL_UNLOAD = (b"255", b"65535")
+_NO_TOOL_CHANGE = object()
+_LINE_WHITESPACE = b" \t\r\f\v"
 
-    def __repr__(self):
-        return f"<GCodeOperation {self.operation} {self.params} {self.comment}>"
 
+def _get_param(params, key):
+    """
+    Returns the value of the last word in ``params`` starting with ``key``
+    """
+    value = None
+    for word in params.split():
+        if word[:1] == key:
+            value = word[1:]
+    return value
 
-def parse_gcode(gcode):
-    operations = []
-    for line in gcode.split("\n"):
-        line = line.strip()
-        if not line:
-            continue
-        if line.startswith(";"):
-            continue
 
-        # logger.debug(f"Parsing line: {line}")
-        operation = GCodeOperation(line)
-        operations.append(operation)
+def _parse_tool_change(params):
+    """
+    Returns the filament selected by an M620 with the given parameters
 
-    return operations
+    None is returned for a full unload and ``_NO_TOOL_CHANGE`` if the M620 does
+    not select a filament.
+    """
+    filament = _get_param(params, b"S")
+    if not filament:
+        return _NO_TOOL_CHANGE
+    if filament in _FULL_UNLOAD:
+        return None
+    if not filament[-1:].isdigit():
+        filament = filament[:-1]
+    return int(filament)
 
 
-def evaluate_gcode(gcode):
+class GCodeEvaluator:
     """
-    Evaluate the gcode and return the filament usage (in mm) per layer
+    Incrementally evaluates G-code and tracks the filament usage (in mm) per layer
+
+    G-code is fed in as bytes in arbitrary chunks. Only complete lines are
+    evaluated, a trailing partial line is held until the next chunk or until
+    :meth:`finish` is called.
     """
-    operations = parse_gcode(gcode)
-    logger.debug(f"Found {len(operations)} operations")
 
-    current_layer = 0  # The current layer
-    current_extrusion = {}  # Running total of extrusion per filament on this layer
-    active_filament = None  # The currently active filament
+    def __init__(self, active_filament=None):
+        self.current_layer = 0  # The current layer
+        self.current_extrusion = {}  # Running total of extrusion on this layer
+        self.active_filament = active_filament  # The currently active filament
 
-    layer_filaments = {}  # Filament usage per layer
+        self.layer_filaments = {}  # Filament usage per layer
 
-    for operation in operations:
-        if operation.operation == "M73":  # Layer change
-            if layer := operation.params.get("L"):
-                next_layer = int(layer)
-                logger.debug(f"Layer change: {current_layer} -> {next_layer}")
+        self._remainder = b""
 
-                if current_extrusion:
-                    # Layer change, record the filament usage
-                    layer_filaments[current_layer] = current_extrusion.copy()
-                    current_extrusion = {}
+    def feed(self, chunk):
+        if not chunk:
+            return
+        data = self._remainder + chunk
+        end = data.rfind(b"\n")
+        if end == -1:
+            self._remainder = data
+            return
+        self._remainder = data[end + 1 :]
+        self._evaluate(data, end)
 
-                current_layer = next_layer
+    def finish(self):
+        """
+        Evaluates any buffered partial line and returns the usage per layer
+        """
+        if self._remainder:
+            data = self._remainder
+            self._remainder = b""
+            self._evaluate(data, len(data))
 
-        if operation.operation == "M620":  # Tool change
-            if filament := operation.params.get("S"):
-                if filament == "255" or filament == "65535":
-                    logger.debug("Full unload")
-                    active_filament = None
-                    continue
-                if not filament[-1].isdigit():
-                    filament = filament[:-1]
-                filament = int(filament)
-                if filament > 65000:
-                    logger.debug(f"Ignoring bogus filament {filament}")
-                    continue
-                logger.debug(f"Filament change from {active_filament} to {filament}")
-                active_filament = filament
+        if self.current_extrusion:
+            self.layer_filaments[self.current_layer] = self.current_extrusion.copy()
+            self.current_extrusion = {}
+        return self.layer_filaments
+
+    def _evaluate(self, data, end):
+        # Hoist the state into locals, this loop runs once per extrusion move
+        current_layer = self.current_layer
+        current_extrusion = self.current_extrusion
+        active_filament = self.active_filament
+        layer_filaments = self.layer_filaments
 
-        if operation.operation in ["G0", "G1", "G2", "G3"]:  # Extrusion
-            if extrusion := operation.params.get("E"):
+        for match in _OPERATION_RE.finditer(data, 0, end):
+            extrusion = match.group("extrusion")
+            if extrusion is not None:  # Extrusion
+                if not extrusion:
+                    continue
                 extrusion_amount = float(extrusion)
                 if active_filament is None:
                     logger.error("No active filament")
@@ -95,7 +128,183 @@ def evaluate_gcode(gcode):
 
                 current_extruded = current_extrusion.get(active_filament, 0)
                 current_extrusion[active_filament] = current_extruded + extrusion_amount
-    # Finished
-    if current_extrusion:
-        layer_filaments[current_layer] = current_extrusion.copy()
+                continue
+
+            params = match.group("m73")
+            if params is not None:  # Layer change
+                if layer := _get_param(params, b"L"):
+                    next_layer = int(layer)
+                    logger.debug(f"Layer change: {current_layer} -> {next_layer}")
+
+                    if current_extrusion:
+                        # Layer change, record the filament usage
+                        layer_filaments[current_layer] = current_extrusion
+                        current_extrusion = {}
+
+                    current_layer = next_layer
+                continue
+
+            filament = _parse_tool_change(match.group("m620"))  # Tool change
+            if filament is _NO_TOOL_CHANGE:
+                continue
+            if filament is None:
+                logger.debug("Full unload")
+            elif filament > 65000:
+                logger.debug(f"Ignoring bogus filament {filament}")
+                continue
+            else:
+                logger.debug(f"Filament change from {active_filament} to {filament}")
+            active_filament = filament
+
+        self.current_layer = current_layer
+        self.current_extrusion = current_extrusion
+        self.active_filament = active_filament
+
+
+def _iter_chunks(gcode):
+    if isinstance(gcode, str):
+        yield gcode.encode()
+    elif isinstance(gcode, (bytes, bytearray, memoryview)):
+        yield bytes(gcode)
+    elif hasattr(gcode, "read"):
+        while chunk := gcode.read(READ_CHUNK_SIZE):
+            yield chunk
+    else:
+        yield from gcode
+
+
+def evaluate_gcode(gcode, cancelled=None):
+    """
+    Evaluate the gcode and return the filament usage (in mm) per layer
+
+    ``gcode`` may be a string, bytes, a binary file-like object or an iterable
+    of byte chunks. The G-code is scanned in a single pass and never held in
+    memory as a whole unless it is passed in that way.
+
+    If the ``cancelled`` event is set during the evaluation, None is returned.
+    """
+    evaluator = GCodeEvaluator()
+    for chunk in _iter_chunks(gcode):
+        if cancelled is not None and cancelled.is_set():
+            logger.debug("GCODE evaluation cancelled")
+            return None
+        evaluator.feed(chunk)
+    return evaluator.finish()
+
+
+def _find_operation(data, operation, group, start=0, end=None):
+    """
+    Finds the next line in ``data[start:end]`` whose operation is ``operation``
+
+    ``group`` is the name of the group capturing the parameters of the
+    operation in ``_OPERATION_RE``. Returns the match of the line, or None if
+    there is no such line.
+    """
+    if end is None:
+        end = len(data)
+    while (position := data.find(operation, start, end)) != -1:
+        line_start = data.rfind(b"\n", 0, position) + 1
+        if not data[line_start:position].strip(_LINE_WHITESPACE):
+            match = _OPERATION_RE.match(data, line_start, end)
+            if match is not None and match.group(group) is not None:
+                return match
+        start = position + len(operation)
+    return None
+
+
+def _scan_tool_changes(data, active_filament):
+    """
+    Returns the active filament after the tool changes in ``data``
+    """
+    position = 0
+    while match := _find_operation(data, b"M620", "m620", position):
+        filament = _parse_tool_change(match.group("m620"))
+        if filament is not _NO_TOOL_CHANGE and (filament is None or filament <= 65000):
+            active_filament = filament
+        position = match.end()
+    return active_filament
+
+
+def _find_segment_boundary(data, start):
+    """
+    Finds the start of the first layer change at or after ``start``
+
+    Only complete lines are considered. Returns None if there is no layer
+    change in the rest of ``data``.
+    """
+    end = data.rfind(b"\n") + 1
+    while match := _find_operation(data, b"M73", "m73", start, end):
+        # A boundary at the very start would produce an empty segment
+        if match.start() > 0 and _get_param(match.group("m73"), b"L"):
+            return match.start()
+        start = match.end()
+    return None
+
+
+def _iter_segments(chunks, segment_size):
+    """
+    Splits the G-code into segments of roughly ``segment_size`` bytes
+
+    Every segment but the first starts with a layer change, so no layer's
+    extrusion is ever split between segments.
+    """
+    pending = bytearray()
+    search_from = segment_size
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) > search_from:
+            boundary = _find_segment_boundary(pending, search_from)
+            if boundary is None:
+                # Continue the search from the last complete line next time
+                search_from = max(search_from, pending.rfind(b"\n") + 1)
+                break
+            yield bytes(pending[:boundary])
+            del pending[:boundary]
+            search_from = segment_size
+    if pending:
+        yield bytes(pending)
+
+
+def _evaluate_segment(segment, active_filament):
+    evaluator = GCodeEvaluator(active_filament)
+    evaluator.feed(segment)
+    return evaluator.finish()
+
+
+def evaluate_gcode_parallel(
+    gcode, workers, segment_size=PARALLEL_SEGMENT_SIZE, cancelled=None
+):
+    """
+    Evaluate the gcode on a pool of ``workers`` processes
+
+    The G-code is split into segments at layer changes. The active filament at
+    the start of each segment is carried over from the tool changes in the
+    segments before it, and the per-layer results are merged in order, so the
+    result is identical to :func:`evaluate_gcode`.
+
+    If the ``cancelled`` event is set during the evaluation, None is returned.
+    """
+    layer_filaments = {}
+    active_filament = None
+    in_flight = deque()
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context("spawn")
+    ) as pool:
+        for segment in _iter_segments(_iter_chunks(gcode), segment_size):
+            if cancelled is not None and cancelled.is_set():
+                logger.debug("GCODE evaluation cancelled")
+                pool.shutdown(cancel_futures=True)
+                return None
+            in_flight.append(pool.submit(_evaluate_segment, segment, active_filament))
+            active_filament = _scan_tool_changes(segment, active_filament)
+
+            # Bound the amount of G-code held in memory
+            while len(in_flight) > workers * 2:
+                layer_filaments.update(in_flight.popleft().result())
+
+        while in_flight:
+            layer_filaments.update(in_flight.popleft().result())
+
+    logger.debug(f"Evaluated GCODE with {workers} workers")
     return layer_filaments
@@ -0,0 +1,89 @@
+import re
+import xml.etree.ElementTree as ET
+
+from loguru import logger
+
+from bambu_spoolman import metrics
+
+SLICE_INFO_PATH = "Metadata/slice_info.config"
+
+# Evaluated usage may differ from the slicer's totals by this fraction, or by
+# TOLERANCE_MM for small amounts, as the slicer rounds to centimetres
+TOLERANCE = 0.02
+TOLERANCE_MM = 10.0
+
+_PLATE_NUMBER_RE = re.compile(r"plate_(\d+)\.gcode$")
+
+
+def parse_slice_info(file):
+    """
+    Parses the filament totals (in mm) per plate from a slice_info.config
+
+    Returns a dict of plate number to a dict of filament to usage. Filaments
+    are numbered from 0, like the tool changes in the G-code.
+    """
+    root = ET.parse(file).getroot()
+
+    plates = {}
+    for plate in root.iter("plate"):
+        number = None
+        for item in plate.iter("metadata"):
+            if item.attrib.get("key") == "index":
+                number = int(item.attrib["value"])
+        if number is None:
+            continue
+
+        totals = {}
+        for filament in plate.iter("filament"):
+            used_m = filament.attrib.get("used_m")
+            if used_m is None:
+                continue
+            index = int(filament.attrib["id"]) - 1
+            totals[index] = totals.get(index, 0.0) + float(used_m) * 1000
+        plates[number] = totals
+    return plates
+
+
+def plate_totals(plates, gcode_path=None):
+    """
+    Returns the totals of the plate whose G-code is at ``gcode_path``
+
+    Without a ``gcode_path`` the totals of the first plate are returned. Returns
+    None if the plate is not in the slice info.
+    """
+    if not plates:
+        return None
+    if gcode_path is None:
+        return plates[min(plates)]
+
+    match = _PLATE_NUMBER_RE.search(gcode_path)
+    if match is None:
+        return None
+    return plates.get(int(match.group(1)))
+
+
+def check_totals(evaluated, expected):
+    """
+    Compares the evaluated usage of a model with the slicer's totals
+
+    Every filament whose usage differs by more than the tolerance is logged
+    and counted in the ``slice_info.mismatches`` metric. Returns True if all
+    filaments are within the tolerance.
+    """
+    matches = True
+    for filament in sorted(set(evaluated) | set(expected)):
+        evaluated_usage = evaluated.get(filament, 0.0)
+        expected_usage = expected.get(filament, 0.0)
+        deviation = abs(evaluated_usage - expected_usage)
+        metrics.observe("slice_info.deviation_mm", deviation)
+
+        if deviation > max(TOLERANCE_MM, expected_usage * TOLERANCE):
+            logger.warning(
+                "Filament {} usage is {:.1f}mm, but the slicer reported {:.1f}mm",
+                filament,
+                evaluated_usage,
+                expected_usage,
+            )
+            metrics.increment("slice_info.mismatches")
+            matches = False
+    return matches
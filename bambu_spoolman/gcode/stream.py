@@ -0,0 +1,326 @@
+import queue
+import struct
+import threading
+import zipfile
+import zlib
+
+from loguru import logger
+
+# Number of chunks buffered between two stages of a pipeline
+PIPE_DEPTH = 16
+
+# Size of the blocks read from the compressed data of a member
+INFLATE_BLOCK_SIZE = 256 * 1024
+
+_LOCAL_FILE_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+_ZIP64_EXTRA_ID = 0x0001
+
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+
+
+class PipeClosed(Exception):
+    """
+    Raised when writing to a pipe that is no longer being read
+    """
+
+
+class _End:
+    def __init__(self, error=None):
+        self.error = error
+
+
+class Pipe:
+    """
+    A bounded buffer of byte chunks between two stages of a pipeline
+
+    The writing stage blocks once ``depth`` chunks are waiting to be read, so
+    a fast stage can never run away from a slow one. Reading is done by
+    iterating over the pipe, which raises any error the writer finished with.
+    Closing the pipe makes both sides raise PipeClosed, so neither is left
+    blocked when the other one goes away.
+    """
+
+    def __init__(self, depth=PIPE_DEPTH):
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+
+    def write(self, chunk):
+        if chunk:
+            self._put(chunk)
+
+    def finish(self, error=None):
+        """
+        Signals the reader that no more chunks will be written
+        """
+        try:
+            self._put(_End(error))
+        except PipeClosed:
+            pass
+
+    def close(self):
+        """
+        Stops the pipe, any further reads and writes raise PipeClosed
+        """
+        self._closed.set()
+        # Unblock a writer waiting for space
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _put(self, item):
+        while True:
+            if self._closed.is_set():
+                raise PipeClosed()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._closed.is_set():
+                    raise PipeClosed()
+                continue
+            if isinstance(item, _End):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+
+
+def start_stage(name, target, pipe):
+    """
+    Runs ``target(pipe.write)`` on a new thread and finishes the pipe with its
+    outcome
+    """
+
+    def run():
+        try:
+            target(pipe.write)
+        except PipeClosed:
+            logger.debug("{} stopped as its pipeline was closed", name)
+            return
+        except Exception as e:
+            pipe.finish(e)
+            return
+        pipe.finish()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+class _ByteReader:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def _fill(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self._buffer += chunk
+        return True
+
+    def read_exact(self, size):
+        if not self._fill(size):
+            raise zipfile.BadZipFile("Unexpected end of archive")
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_some(self, size):
+        """
+        Reads up to ``size`` bytes, only returning less at the end of the data
+        """
+        self._fill(1)
+        data = bytes(self._buffer[:size])
+        del self._buffer[: len(data)]
+        return data
+
+    def peek(self, size):
+        self._fill(size)
+        return bytes(self._buffer[:size])
+
+    def unread(self, data):
+        self._buffer[:0] = data
+
+
+class ZipStreamMember:
+    """
+    A member of a zip archive that is being read sequentially
+
+    Its data has to be consumed through :meth:`decompress_into` before the
+    next member of the archive can be read. Without a data descriptor,
+    ``CRC``, ``compress_size`` and ``file_size`` are known from the local
+    header. Otherwise they are known once the data has been read.
+    """
+
+    def __init__(self, reader, filename, flags, method, crc, compress_size, size):
+        self.filename = filename
+        self.flags = flags
+        self.method = method
+        self.CRC = crc
+        self.compress_size = compress_size
+        self.file_size = size
+        self.zip64 = False
+        self.consumed = False
+
+        self._reader = reader
+
+    @property
+    def has_data_descriptor(self):
+        return bool(self.flags & _FLAG_DATA_DESCRIPTOR)
+
+    def decompress_into(self, write):
+        """
+        Decompresses the data of the member, passing it to ``write`` in chunks
+        """
+        if self.consumed:
+            raise ValueError(f"Data of {self.filename} was already read")
+        self.consumed = True
+
+        if self.flags & _FLAG_ENCRYPTED:
+            raise zipfile.BadZipFile(f"{self.filename} is encrypted")
+        if self.method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif self.method == zipfile.ZIP_STORED and not self.has_data_descriptor:
+            decompressor = None
+        else:
+            raise zipfile.BadZipFile(
+                f"{self.filename} uses compression method {self.method} with "
+                f"flags {self.flags:#x}, which can't be streamed"
+            )
+
+        try:
+            crc, size = self._decompress(decompressor, write)
+        except zlib.error as e:
+            raise zipfile.BadZipFile(f"Corrupt data in {self.filename}: {e}") from e
+
+        if crc != self.CRC or size != self.file_size:
+            raise zipfile.BadZipFile(f"Bad CRC-32 or size for {self.filename}")
+
+    def _decompress(self, decompressor, write):
+        crc = 0
+        size = 0
+        if self.has_data_descriptor:
+            # The end of the data is only known from the deflate stream itself
+            while not decompressor.eof:
+                block = self._reader.read_some(INFLATE_BLOCK_SIZE)
+                if not block:
+                    raise zipfile.BadZipFile("Unexpected end of archive")
+                data = decompressor.decompress(block)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                write(data)
+            self._reader.unread(decompressor.unused_data)
+            self._read_data_descriptor()
+        else:
+            remaining = self.compress_size
+            while remaining:
+                block = self._reader.read_exact(min(remaining, INFLATE_BLOCK_SIZE))
+                remaining -= len(block)
+                data = decompressor.decompress(block) if decompressor else block
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                write(data)
+            if decompressor is not None:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                write(data)
+        return crc, size
+
+    def skip(self):
+        """
+        Skips over the data of the member
+        """
+        if self.consumed:
+            return
+        if self.has_data_descriptor:
+            self.decompress_into(lambda data: None)
+            return
+        self.consumed = True
+        remaining = self.compress_size
+        while remaining:
+            remaining -= len(
+                self._reader.read_exact(min(remaining, INFLATE_BLOCK_SIZE))
+            )
+
+    def _read_data_descriptor(self):
+        if self._reader.peek(4) == _DATA_DESCRIPTOR_SIGNATURE:
+            self._reader.read_exact(4)
+        if self.zip64:
+            self.CRC, self.compress_size, self.file_size = struct.unpack(
+                "<IQQ", self._reader.read_exact(20)
+            )
+        else:
+            self.CRC, self.compress_size, self.file_size = struct.unpack(
+                "<III", self._reader.read_exact(12)
+            )
+
+
+def iter_zip_members(chunks):
+    """
+    Reads a zip archive sequentially from an iterable of byte chunks
+
+    Yields a :class:`ZipStreamMember` for each member, in archive order, using
+    the local file headers. A member that wasn't consumed is skipped when the
+    next one is requested.
+    """
+    reader = _ByteReader(chunks)
+    while True:
+        if reader.peek(4) != _LOCAL_FILE_HEADER_SIGNATURE:
+            # Reached the central directory
+            return
+
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compress_size,
+            size,
+            name_length,
+            extra_length,
+        ) = _LOCAL_FILE_HEADER.unpack(reader.read_exact(_LOCAL_FILE_HEADER.size))
+
+        filename = reader.read_exact(name_length).decode(
+            "utf-8" if flags & 0x800 else "cp437"
+        )
+        extra = reader.read_exact(extra_length)
+
+        member = ZipStreamMember(
+            reader, filename, flags, method, crc, compress_size, size
+        )
+        _apply_zip64_extra(member, extra)
+
+        yield member
+        member.skip()
+
+
+def _apply_zip64_extra(member, extra):
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, position)
+        position += 4
+        if header_id == _ZIP64_EXTRA_ID:
+            member.zip64 = True
+            field = extra[position : position + length]
+            if member.file_size == 0xFFFFFFFF and len(field) >= 8:
+                (member.file_size,) = struct.unpack_from("<Q", field)
+                field = field[8:]
+            if member.compress_size == 0xFFFFFFFF and len(field) >= 8:
+                (member.compress_size,) = struct.unpack_from("<Q", field)
+            return
+        position += length
@@ -0,0 +1,69 @@
+from array import array
+
+
+class LayerUsage:
+    """
+    Filament usage (in mm) of an evaluated model
+
+    The usage is stored as one contiguous array of cumulative sums per
+    filament, indexed by layer, so the usage of any range of layers is a
+    single subtraction per filament.
+    """
+
+    def __init__(self, layer_filaments):
+        """
+        Builds the usage from the per-layer dicts returned by the evaluator
+        """
+        if layer_filaments:
+            self.first_layer = min(layer_filaments)
+            self.last_layer = max(layer_filaments)
+        else:
+            self.first_layer = 0
+            self.last_layer = -1
+
+        layer_count = self.last_layer - self.first_layer + 1
+        filaments = sorted(
+            {filament for usage in layer_filaments.values() for filament in usage}
+        )
+
+        self._cumulative = {}
+        for filament in filaments:
+            cumulative = array("d", [0.0]) * (layer_count + 1)
+            total = 0.0
+            for index in range(layer_count):
+                layer_usage = layer_filaments.get(self.first_layer + index)
+                if layer_usage is not None:
+                    total += layer_usage.get(filament, 0)
+                cumulative[index + 1] = total
+            self._cumulative[filament] = cumulative
+
+    def between(self, first_layer, last_layer):
+        """
+        Returns the usage per filament of the layers from ``first_layer`` up to
+        and including ``last_layer``
+        """
+        first_layer = max(first_layer, self.first_layer)
+        last_layer = min(last_layer, self.last_layer)
+        if first_layer > last_layer:
+            return {}
+
+        start = first_layer - self.first_layer
+        end = last_layer - self.first_layer + 1
+
+        usage = {}
+        for filament, cumulative in self._cumulative.items():
+            if cumulative[end] != cumulative[start]:
+                usage[filament] = cumulative[end] - cumulative[start]
+        return usage
+
+    def layer(self, layer):
+        """
+        Returns the usage per filament of a single layer
+        """
+        return self.between(layer, layer)
+
+    def totals(self):
+        """
+        Returns the usage per filament of the whole model
+        """
+        return self.between(self.first_layer, self.last_layer)
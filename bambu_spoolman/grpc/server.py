@@ -1,3 +1,5 @@
+import asyncio
+
 import grpc
 from google.protobuf.empty_pb2 import Empty
 from google.protobuf.json_format import ParseDict
@@ -10,6 +12,7 @@ from bambu_spoolman.bambu_mqtt import stateful_printer_info
 from bambu_spoolman.broker.automatic_spool_switch import AutomaticSpoolSwitch
 from bambu_spoolman.grpc import bambu_spoolman_pb2_grpc
 from bambu_spoolman.settings import load_settings, save_settings
+from bambu_spoolman.spoolman import async_instance
 from bambu_spoolman.spoolman import instance as spoolman_instance
 
 
@@ -35,24 +38,31 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
         )
 
     async def Info(self, request: Empty, context: ServicerContext):
-        features = pb2.Features(
-            tray_locking=spoolman_instance().supports_tray_locking()
-        )
+        features = pb2.Features(tray_locking=async_instance().supports_tray_locking())
         return pb2.InfoResponse(
-            spoolman_url=spoolman_instance().endpoint,
-            spoolman_valid=spoolman_instance().validate(),
+            spoolman_url=async_instance().endpoint,
+            spoolman_valid=await async_instance().validate(
+                timeout=context.time_remaining()
+            ),
             features=features,
         )
 
     async def GetSpools(self, request: pb2.GetSpoolsRequest, context: ServicerContext):
         if len(request.spool_id) == 0:
             # Retrieve all spools
-            spools = spoolman_instance().get_spools()
+            spools = await async_instance().get_spools(
+                use_cache=True, timeout=context.time_remaining()
+            )
         else:
             # Retrieve specific spools by ID
-            spools = [
-                spoolman_instance().get_spool(spool_id) for spool_id in request.spool_id
-            ]
+            spools = await asyncio.gather(
+                *(
+                    async_instance().get_spool(
+                        spool_id, use_cache=True, timeout=context.time_remaining()
+                    )
+                    for spool_id in request.spool_id
+                )
+            )
         return pb2.GetSpoolsResponse(
             spools=[
                 ParseDict(spool, spoolman_pb2.Spool(), ignore_unknown_fields=True)
@@ -85,10 +95,24 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
             )
 
         tray_id_int = int(tray_id)
+        # Calculate AMS and tray slot (both 1-indexed for display)
+        ams_num = (tray_id_int // 4) + 1
+        tray_num = (tray_id_int % 4) + 1
 
         # Get the old spool_id if there was one, so we can clear its tray field
         # Try both string and int keys for compatibility
         old_spool_id = trays.get(tray_id) or trays.get(tray_id_int)
+        if old_spool_id is None:
+            # Spoolman may still record a spool in the tray
+            try:
+                old_spool = await async_instance().lookup_by_tray(
+                    ams_num, tray_num, timeout=context.time_remaining()
+                )
+            except Exception as e:
+                logger.warning(f"Failed to look up the spool in tray {tray_id}: {e}")
+                old_spool = None
+            if old_spool is not None:
+                old_spool_id = old_spool["id"]
 
         if spool_id == -1:
             # Clearing the tray assignment
@@ -99,14 +123,19 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
             # Clear the tray fields in Spoolman for the old spool
             if old_spool_id is not None:
                 try:
-                    spoolman_instance().set_active_tray(old_spool_id, None, None)
+                    await async_instance().set_active_tray(
+                        old_spool_id, None, None, timeout=context.time_remaining()
+                    )
                 except Exception as e:
                     logger.error(
                         f"Failed to clear tray fields for spool {old_spool_id}: {e}"
                     )
         else:
             spool_id = int(spool_id)
-            spool = spoolman_instance().get_spool(spool_id)
+            # Read from Spoolman, so setting the tray fields below can reuse it
+            spool = await async_instance().get_spool(
+                spool_id, timeout=context.time_remaining()
+            )
             if spool is None:
                 await context.abort(grpc.StatusCode.NOT_FOUND, "Spool not found")
 
@@ -120,19 +149,19 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
             trays[tray_id] = spool_id
 
             # Set the tray fields in Spoolman for the new spool
-            # Calculate AMS and tray slot (both 1-indexed for display)
-            ams_num = (tray_id_int // 4) + 1
-            tray_num = (tray_id_int % 4) + 1
-
             try:
-                spoolman_instance().set_active_tray(spool_id, ams_num, tray_num)
+                await async_instance().set_active_tray(
+                    spool_id, ams_num, tray_num, timeout=context.time_remaining()
+                )
             except Exception as e:
                 logger.error(f"Failed to set tray fields for spool {spool_id}: {e}")
 
             # Clear the tray fields for the old spool if it was different
             if old_spool_id is not None and old_spool_id != spool_id:
                 try:
-                    spoolman_instance().set_active_tray(old_spool_id, None, None)
+                    await async_instance().set_active_tray(
+                        old_spool_id, None, None, timeout=context.time_remaining()
+                    )
                 except Exception as e:
                     logger.error(
                         f"Failed to clear tray fields for old spool {old_spool_id}: {e}"
@@ -145,7 +174,9 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
     async def GetSpoolByUUID(
         self, request: pb2.GetSpoolbyUUIDRequest, context: ServicerContext
     ):
-        spool = spoolman_instance().lookup_by_tray_uuid(request.uuid)
+        spool = await async_instance().lookup_by_tray_uuid(
+            request.uuid, timeout=context.time_remaining()
+        )
         if spool is None:
             await context.abort(grpc.StatusCode.NOT_FOUND, "Spool not found")
         return ParseDict(spool, spoolman_pb2.Spool(), ignore_unknown_fields=True)
@@ -156,22 +187,29 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
         tray_uuid = request.uuid
         spool_id = request.spool_id
 
-        spool = spoolman_instance().get_spool(spool_id)
+        spool = await async_instance().get_spool(
+            spool_id, use_cache=True, timeout=context.time_remaining()
+        )
 
         logger.debug(f"spool: {spool}")
 
         if spool is None:
             await context.abort(grpc.StatusCode.NOT_FOUND, "Spool not found")
 
-        if not spoolman_instance().supports_tray_locking():
+        if not async_instance().supports_tray_locking():
             await context.abort(
                 grpc.StatusCode.UNIMPLEMENTED,
                 "Spoolman instance does not support tray locking",
             )
 
-        success = spoolman_instance().set_tray_uuid(spool_id, tray_uuid)
+        # Record the tray the spool is loaded in with the same request, so
+        # locking it below finds its tray fields already up to date
+        ams_num, tray_num = _find_tray(tray_uuid)
+        success = await async_instance().set_tray_uuid(
+            spool_id, tray_uuid, ams_num, tray_num, timeout=context.time_remaining()
+        )
 
-        AutomaticSpoolSwitch.get_instance().sync()
+        await asyncio.to_thread(_sync_trays, context.time_remaining())
 
         if not success:
             await context.abort(
@@ -180,6 +218,26 @@ class BambuSpoolmanServicer(bambu_spoolman_pb2_grpc.BambuSpoolmanServicer):
         return Empty()
 
 
+def _find_tray(tray_uuid):
+    """
+    Returns the AMS and tray numbers (1-indexed) of the tray holding the spool
+    with the given UUID, or (None, None) if it isn't loaded
+    """
+    if not stateful_printer_info.connected:
+        return None, None
+    ams = stateful_printer_info.get_info().get("print", {}).get("ams", {})
+    for data in ams.get("ams", []):
+        for tray in data.get("tray", []):
+            if tray.get("tray_uuid") == tray_uuid:
+                return int(data["id"]) + 1, int(tray["id"]) + 1
+    return None, None
+
+
+def _sync_trays(timeout):
+    with spoolman_instance().deadline(timeout):
+        AutomaticSpoolSwitch.get_instance().sync()
+
+
 async def serve(host: str = "0.0.0.0", port: int = 50051):
     server = grpc.aio.server()
     bambu_spoolman_pb2_grpc.add_BambuSpoolmanServicer_to_server(
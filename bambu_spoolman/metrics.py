@@ -0,0 +1,94 @@
+import threading
+import time
+
+from loguru import logger
+
+_lock = threading.Lock()
+_counters = {}
+_summaries = {}
+
+
+class _Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+def increment(name, amount=1):
+    """
+    Adds ``amount`` to the counter with the given name
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, value):
+    """
+    Records a sample (e.g. a duration or a rate) of the summary with the given name
+    """
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            summary = _summaries[name] = _Summary()
+        summary.observe(value)
+
+
+def snapshot():
+    """
+    Returns the current value of every counter and summary
+    """
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "summaries": {
+                name: summary.as_dict() for name, summary in _summaries.items()
+            },
+        }
+
+
+def report():
+    """
+    Logs the current value of every counter and summary
+    """
+    metrics = snapshot()
+    for name, value in sorted(metrics["counters"].items()):
+        logger.info("{}: {}", name, value)
+    for name, summary in sorted(metrics["summaries"].items()):
+        logger.info(
+            "{}: count={} mean={:.3f} min={:.3f} max={:.3f}",
+            name,
+            summary["count"],
+            summary["mean"],
+            summary["min"],
+            summary["max"],
+        )
+
+
+def start_reporting(interval):
+    """
+    Logs the metrics every ``interval`` seconds on a background thread
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            report()
+
+    threading.Thread(target=run, name="Metrics", daemon=True).start()
@@ -0,0 +1,172 @@
+import threading
+import time
+
+
+class SpoolMirror:
+    """
+    An in-memory copy of the spools in Spoolman
+
+    Spools are indexed by id, by the tray UUID stored in the configured extra
+    field and by the AMS and tray they are assigned to, so lookups don't need
+    to scan the whole inventory. Spools returned by the mirror are shared and
+    must not be modified.
+    """
+
+    def __init__(self, uuid_field=None, ams_field=None, tray_field=None):
+        self.uuid_field = uuid_field
+        self.ams_field = ams_field
+        self.tray_field = tray_field
+
+        self._lock = threading.Lock()
+        self._replace_lock = threading.Lock()
+        # Changes made while a full listing is being consumed, replayed on top
+        # of the listing once it's complete
+        self._changes = None
+        self._spools = {}
+        self._by_uuid = {}
+        self._by_tray = {}
+        self._updated_at = {}  # Spool ID -> monotonic time of its last update
+        self.refreshed_at = None  # Monotonic time of the last full refresh
+
+    @property
+    def loaded(self):
+        return self.refreshed_at is not None
+
+    def age(self):
+        """
+        Returns the number of seconds since the last full refresh
+        """
+        if self.refreshed_at is None:
+            return float("inf")
+        return time.monotonic() - self.refreshed_at
+
+    def replace(self, spools):
+        """
+        Replaces the contents of the mirror with a full listing of spools
+
+        The listing may be consumed lazily, the mirror keeps serving its
+        current contents until it is complete.
+        """
+        with self._replace_lock:
+            with self._lock:
+                self._changes = []
+            try:
+                fresh = SpoolMirror(self.uuid_field, self.ams_field, self.tray_field)
+                for spool in spools:
+                    fresh._add(spool)
+            finally:
+                with self._lock:
+                    changes, self._changes = self._changes, None
+
+            with self._lock:
+                for spool_id, spool in changes:
+                    fresh._discard(spool_id)
+                    if spool is not None:
+                        fresh._add(spool, replace=True)
+                self._spools = fresh._spools
+                self._by_uuid = fresh._by_uuid
+                self._by_tray = fresh._by_tray
+                self.refreshed_at = time.monotonic()
+
+    def update(self, spool):
+        """
+        Adds or replaces a single spool
+        """
+        with self._lock:
+            self._discard(spool["id"])
+            self._add(spool, replace=True)
+            self._updated_at[spool["id"]] = time.monotonic()
+            if self._changes is not None:
+                self._changes.append((spool["id"], spool))
+
+    def update_filament(self, filament):
+        """
+        Replaces the filament of every spool of that filament
+        """
+        with self._lock:
+            spools = [
+                spool
+                for spool in self._spools.values()
+                if spool.get("filament", {}).get("id") == filament["id"]
+            ]
+        for spool in spools:
+            self.update({**spool, "filament": filament})
+
+    def remove(self, spool_id):
+        with self._lock:
+            self._discard(spool_id)
+            self._updated_at.pop(spool_id, None)
+            if self._changes is not None:
+                self._changes.append((spool_id, None))
+
+    def get(self, spool_id, max_age=None):
+        """
+        Returns a spool, or None if it isn't mirrored or, with ``max_age``,
+        if it wasn't refreshed or updated in the last ``max_age`` seconds
+        """
+        with self._lock:
+            if max_age is not None:
+                updated_at = max(
+                    self._updated_at.get(spool_id, float("-inf")),
+                    self.refreshed_at or float("-inf"),
+                )
+                if time.monotonic() - updated_at > max_age:
+                    return None
+            return self._spools.get(spool_id)
+
+    def all(self):
+        with self._lock:
+            return list(self._spools.values())
+
+    def by_uuid(self, tray_uuid):
+        with self._lock:
+            spool_id = self._by_uuid.get(f'"{tray_uuid}"')
+            return self._spools.get(spool_id)
+
+    def by_tray(self, ams_num, tray_num):
+        with self._lock:
+            spool_id = self._by_tray.get((f'"{ams_num}"', f'"{tray_num}"'))
+            return self._spools.get(spool_id)
+
+    def _add(self, spool, replace=False):
+        spool_id = spool["id"]
+        self._spools[spool_id] = spool
+
+        # When a value is shared by several spools, the first one listed wins,
+        # unless the spool was just written to
+        if (uuid := self._uuid_key(spool)) is not None:
+            if replace:
+                self._by_uuid[uuid] = spool_id
+            else:
+                self._by_uuid.setdefault(uuid, spool_id)
+        if (tray := self._tray_key(spool)) is not None:
+            if replace:
+                self._by_tray[tray] = spool_id
+            else:
+                self._by_tray.setdefault(tray, spool_id)
+
+    def _discard(self, spool_id):
+        spool = self._spools.pop(spool_id, None)
+        if spool is None:
+            return
+        uuid = self._uuid_key(spool)
+        if uuid is not None and self._by_uuid.get(uuid) == spool_id:
+            del self._by_uuid[uuid]
+        tray = self._tray_key(spool)
+        if tray is not None and self._by_tray.get(tray) == spool_id:
+            del self._by_tray[tray]
+
+    def _uuid_key(self, spool):
+        if self.uuid_field is None:
+            return None
+        return spool.get("extra", {}).get(self.uuid_field)
+
+    def _tray_key(self, spool):
+        if self.ams_field is None or self.tray_field is None:
+            return None
+        extra = spool.get("extra", {})
+        ams = extra.get(self.ams_field)
+        tray = extra.get(self.tray_field)
+        if ams in (None, '""') or tray in (None, '""'):
+            return None
+        return (ams, tray)
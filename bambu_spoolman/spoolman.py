@@ -1,9 +1,42 @@
+import asyncio
+import contextlib
+import functools
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 import requests
 import urllib3
 from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bambu_spoolman import metrics
+from bambu_spoolman.catalog_mirror import CatalogMirror
+from bambu_spoolman.circuit_breaker import CircuitBreaker, CircuitOpenError
+from bambu_spoolman.external_filament_cache import ExternalFilamentCache
+from bambu_spoolman.external_filament_index import ExternalFilamentIndex
+from bambu_spoolman.spool_mirror import SpoolMirror
+from bambu_spoolman.spoolman_feed import SpoolmanChangeFeed
+
+# Minimum age of a mirror before a lookup miss refreshes it
+MIRROR_MISS_REFRESH_SECONDS = 5
+
+# Maximum age of a mirrored spool that is written to without reading it first.
+# The change feed isn't relied on here, as it may not have delivered the
+# latest edit yet
+FRESH_SPOOL_SECONDS = 5
+
+# A request that succeeded this many seconds ago is as good as a health check
+HEALTH_CHECK_SECONDS = 10
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised instead of sending a request after the caller's deadline passed
+    """
 
 
 class SpoolmanClient:
@@ -14,89 +47,176 @@ class SpoolmanClient:
     def __init__(self, endpoint):
         self.endpoint = endpoint
         self.verify = os.environ.get("SPOOLMAN_VERIFY", "true").lower() == "true"
-        self._external_filaments_cache = None
-        self._external_filaments_cache_time = None
+        self._external_filaments = ExternalFilamentCache(
+            functools.partial(
+                self._request, "GET", self._make_api_route("external/filament")
+            )
+        )
+        self._external_filament_index = None
+        color_distance = os.environ.get("SPOOLMAN_COLOR_MATCH_DISTANCE")
+        self.color_match_distance = (
+            float(color_distance) if color_distance is not None else None
+        )
         self.ams_field_name = os.environ.get("SPOOLMAN_AMS_FIELD_NAME")
         self.tray_field_name = os.environ.get("SPOOLMAN_TRAY_FIELD_NAME")
 
         if not self.verify:
             urllib3.disable_warnings()
 
+        self.timeout = (
+            float(os.environ.get("SPOOLMAN_CONNECT_TIMEOUT", "5")),
+            float(os.environ.get("SPOOLMAN_READ_TIMEOUT", "30")),
+        )
+        self.pool_size = int(os.environ.get("SPOOLMAN_POOL_SIZE", "10"))
+        self.page_size = int(os.environ.get("SPOOLMAN_PAGE_SIZE", "500"))
+        self.session = _new_session(
+            self.verify,
+            pool_size=self.pool_size,
+            retries=int(os.environ.get("SPOOLMAN_RETRIES", "3")),
+        )
+        self.breaker = CircuitBreaker(
+            "Spoolman",
+            failure_threshold=int(os.environ.get("SPOOLMAN_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.environ.get("SPOOLMAN_BREAKER_RESET", "30")),
+        )
+
+        self.mirror = SpoolMirror(
+            os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME"),
+            self.ams_field_name,
+            self.tray_field_name,
+        )
+        self.mirror_interval = float(os.environ.get("SPOOLMAN_MIRROR_INTERVAL", "60"))
+        self._mirror_lock = threading.Lock()
+        self._mirror_thread = None
+        self.catalog = CatalogMirror()
+        self.change_feed = None
+        self._catalog_lock = threading.Lock()
+        self._catalog_thread = None
+
     def validate(self):
         """
         Validates the connection to the Spoolman API
+        No request is sent if another one just succeeded or the circuit
+        breaker is open
         """
-        response = requests.get(self._make_api_route("health"), verify=self.verify)
+        if self.breaker.open:
+            return False
+        succeeded_at = self.breaker.succeeded_at
+        if (
+            succeeded_at is not None
+            and time.monotonic() - succeeded_at < HEALTH_CHECK_SECONDS
+        ):
+            return True
+        try:
+            response = self._request("GET", self._make_api_route("health"))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Spoolman health check failed: {}", e)
+            return False
         return response.status_code == 200
 
     def get_info(self):
         """
         Get information about the Spoolman instance
         """
-        response = requests.get(self._make_api_route("info"), verify=self.verify)
+        response = self._request("GET", self._make_api_route("info"))
         return response.json()
 
     def get_filaments(self):
         """
         Get a list of all filaments
         """
-        response = requests.get(self._make_api_route("filament"), verify=self.verify)
+        response = self._request("GET", self._make_api_route("filament"))
         return response.json()
 
-    def get_spools(self):
+    def get_spools(self, use_cache=False):
         """
         Get a list of all spools
+        Set use_cache=True to read them from the local spool mirror
+        The mirror is also used while the circuit breaker is open
         """
-        response = requests.get(self._make_api_route("spool"), verify=self.verify)
-        return response.json()
+        if use_cache or (self.breaker.open and self.mirror.loaded):
+            self._load_mirror()
+            return self.mirror.all()
 
-    def get_external_filaments(self, use_cache=True):
+        spools = list(self.iter_spools())
+        self.mirror.replace(spools)
+        return spools
+
+    def iter_spools(self, allow_archived=False):
         """
-        Get a list of all external filaments from SpoolmanDB
-        Caches the result for 1 hour to avoid repeated large fetches
-        Set use_cache=False to force a fresh fetch
-        """
-        # Check cache (1 hour = 3600 seconds)
-        cache_ttl = 3600
-        if use_cache and self._external_filaments_cache is not None:
-            if self._external_filaments_cache_time is not None:
-                age = time.time() - self._external_filaments_cache_time
-                if age < cache_ttl:
-                    logger.debug(f"Using cached external filaments ({int(age)}s old)")
-                    return self._external_filaments_cache
-
-        # Fetch fresh data
-        try:
-            logger.info("Fetching external filaments from SpoolmanDB...")
-            response = requests.get(
-                self._make_api_route("external/filament"),
-                verify=self.verify,
+        Iterates over all spools, fetching them a page at a time
+        Archived spools are left out by Spoolman unless allow_archived=True
+        """
+        offset = 0
+        while True:
+            response = self._request(
+                "GET",
+                self._make_api_route(
+                    "spool",
+                    allow_archived=str(allow_archived).lower(),
+                    sort="id:asc",
+                    limit=self.page_size,
+                    offset=offset,
+                ),
             )
             response.raise_for_status()
+            page = response.json()
+            yield from page
 
-            data = response.json()
-            # Update cache
-            self._external_filaments_cache = data
-            self._external_filaments_cache_time = time.time()
-            logger.info(f"Cached {len(data)} external filaments")
-            return data
-        except Exception as e:
-            logger.error(f"Exception getting external filaments: {e}")
-            return (
-                self._external_filaments_cache or []
-            )  # Return stale cache if available
+            offset += len(page)
+            total = response.headers.get("X-Total-Count")
+            if len(page) < self.page_size or (
+                total is not None and offset >= int(total)
+            ):
+                return
+
+    def refresh_mirror(self):
+        """
+        Replaces the contents of the spool mirror with the spools in Spoolman
+        """
+        self.mirror.replace(self.iter_spools())
+        logger.debug("Refreshed spool mirror")
+
+    def get_external_filaments(self, use_cache=True):
+        """
+        Get a list of all external filaments from SpoolmanDB
+        The list is cached on disk and revalidated in the background once it
+        is older than 1 hour, to avoid repeated large fetches
+        Set use_cache=False to revalidate it before returning
+        """
+        if not use_cache:
+            self._external_filaments.refresh()
+        return self._external_filaments.get()
 
-    def get_spool(self, spool_id):
+    def preload_external_filaments(self):
+        """
+        Loads the external filaments in the background, so the first auto
+        created spool doesn't wait for them
+        """
+        self._external_filaments.preload()
+
+    def get_spool(self, spool_id, use_cache=False):
         """
         Get a specific spool by ID
+        Set use_cache=True to read it from the local spool mirror if it's there
+        The mirror is also used while the circuit breaker is open
         """
+        if use_cache or self.breaker.open:
+            if use_cache:
+                self._load_mirror()
+            spool = self.mirror.get(spool_id)
+            if spool is not None:
+                return spool
+
         try:
-            response = requests.get(
-                self._make_api_route(f"spool/{spool_id}"), verify=self.verify
-            )
+            response = self._request("GET", self._make_api_route(f"spool/{spool_id}"))
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError:
+            spool = response.json()
+            self._mirror_spool(spool)
+            return spool
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                self.mirror.remove(spool_id)
             return None
 
     def consume_spool(self, spool_id, *, length=None, weight=None):
@@ -106,15 +226,18 @@ class SpoolmanClient:
         assert length or weight, "Must provide either length or weight"
         assert not (length and weight), "Must provide either length or weight, not both"
 
-        response = requests.put(
+        response = self._request(
+            "PUT",
             self._make_api_route(f"spool/{spool_id}/use"),
             json={
                 "use_length": length,
                 "use_weight": weight,
             },
-            verify=self.verify,
         )
-        return response.json()
+        response.raise_for_status()
+        spool = response.json()
+        self._mirror_spool(spool)
+        return spool
 
     def lookup_by_tray_uuid(self, tray_uuid):
         """
@@ -123,42 +246,77 @@ class SpoolmanClient:
         extra_field = os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME")
         if extra_field is None:
             return None
-        all_spools = self.get_spools()
 
-        for spool in all_spools:
-            extra = spool.get("extra", {})
+        self._load_mirror()
+        spool = self.mirror.by_uuid(tray_uuid)
+        if (
+            spool is None
+            and not self._change_feed_live()
+            and self.mirror.age() > MIRROR_MISS_REFRESH_SECONDS
+        ):
+            # The spool may have been tagged in Spoolman since the last refresh
+            self.refresh_mirror()
+            spool = self.mirror.by_uuid(tray_uuid)
+        return spool
 
-            data = extra.get(extra_field, None)
-            if data is not None and data == f'"{tray_uuid}"':
-                return spool
-        return None
+    def lookup_by_tray(self, ams_num, tray_num):
+        """
+        Looks up the spool assigned to an AMS tray in the spool mirror
+        """
+        self._load_mirror()
+        return self.mirror.by_tray(ams_num, tray_num)
 
-    def set_tray_uuid(self, spool_id, tray_uuid):
+    def set_tray_uuid(self, spool_id, tray_uuid, ams_num=None, tray_num=None):
         """
         Sets a tray's uuid
+        If ams_num and tray_num are given, the spool's tray fields are set in
+        the same request
         """
         extra_field = os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME")
         if extra_field is None:
             return False
-        existing_spool = self.get_spool(spool_id)
-        if existing_spool is None:
-            return False
-        # Get extra data
-        extra = existing_spool.get("extra", {})
-        # Set the new tray uuid
-        extra[extra_field] = f'"{tray_uuid}"'
-        # Update the spool
+        changes = {extra_field: f'"{tray_uuid}"'}
+        if ams_num is not None and tray_num is not None:
+            changes.update(self._tray_fields(ams_num, tray_num))
         try:
-            response = requests.patch(
-                self._make_api_route(f"spool/{spool_id}"),
-                json={"extra": extra},
-                verify=self.verify,
-            )
-            response.raise_for_status()
-            return True
+            return self.update_extra(spool_id, changes)
         except requests.exceptions.HTTPError:
             return False
 
+    def update_extra(self, spool_id, changes):
+        """
+        Sets extra fields of a spool
+
+        The changes are compared against the current version of the spool and
+        only sent, in a single request, if any of them differ. The mirrored
+        copy of the spool is used as the current version if it was fetched or
+        written in the last FRESH_SPOOL_SECONDS, otherwise the spool is read
+        first. Spoolman replaces all extra fields at once, so an extra field
+        edited in Spoolman within that window, or between the read and the
+        write, is overwritten.
+
+        Returns False if the spool doesn't exist
+        """
+        spool = self._current_spool(spool_id)
+        if spool is None:
+            return False
+
+        extra = dict(spool.get("extra", {}))
+        if all(extra.get(field) == value for field, value in changes.items()):
+            logger.debug("Extra fields of spool {} are up to date", spool_id)
+            return True
+
+        # Spoolman replaces all extra fields, so the others are sent as well
+        extra.update(changes)
+        response = self._request(
+            "PATCH",
+            self._make_api_route(f"spool/{spool_id}"),
+            json={"extra": extra},
+        )
+        response.raise_for_status()
+        self._mirror_spool(response.json())
+        return True
+
     def supports_tray_locking(self):
         return os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME") is not None
 
@@ -184,36 +342,10 @@ class SpoolmanClient:
             )
             return False
 
-        existing_spool = self.get_spool(spool_id)
-        if existing_spool is None:
-            logger.warning(f"Spool {spool_id} not found, cannot set tray fields")
-            return False
-
-        # Get extra data
-        extra = existing_spool.get("extra", {})
-
-        # Set or clear the AMS field
-        if self.ams_field_name:
-            if ams_num is not None:
-                extra[self.ams_field_name] = f'"{ams_num}"'
-            else:
-                extra[self.ams_field_name] = f'""'
-
-        # Set or clear the tray field
-        if self.tray_field_name:
-            if tray_num is not None:
-                extra[self.tray_field_name] = f'"{tray_num}"'
-            else:
-                extra[self.tray_field_name] = f'""'
-
-        # Update the spool
         try:
-            response = requests.patch(
-                self._make_api_route(f"spool/{spool_id}"),
-                json={"extra": extra},
-                verify=self.verify,
-            )
-            response.raise_for_status()
+            if not self.update_extra(spool_id, self._tray_fields(ams_num, tray_num)):
+                logger.warning(f"Spool {spool_id} not found, cannot set tray fields")
+                return False
             logger.debug(
                 f"Set AMS/tray fields for spool {spool_id}: AMS={ams_num}, Tray={tray_num}"
             )
@@ -224,15 +356,37 @@ class SpoolmanClient:
             )
             return False
 
-    def create_spool(self, filament_id, tray_uuid, initial_weight=1000):
+    def _tray_fields(self, ams_num, tray_num):
+        """
+        Returns the extra fields that record the AMS and tray of a spool
+        """
+        fields = {}
+        # Set or clear the AMS field
+        if self.ams_field_name:
+            fields[self.ams_field_name] = (
+                f'"{ams_num}"' if ams_num is not None else '""'
+            )
+        # Set or clear the tray field
+        if self.tray_field_name:
+            fields[self.tray_field_name] = (
+                f'"{tray_num}"' if tray_num is not None else '""'
+            )
+        return fields
+
+    def create_spool(
+        self, filament_id, tray_uuid, initial_weight=1000, ams_num=None, tray_num=None
+    ):
         """
         Creates a new spool in Spoolman
+        If ams_num and tray_num are given, the spool's tray fields are set too
         Returns the created spool or None on failure
         """
         extra_field = os.environ.get("SPOOLMAN_SPOOL_FIELD_NAME")
         extra = {}
         if extra_field:
             extra[extra_field] = f'"{tray_uuid}"'
+        if ams_num is not None and tray_num is not None:
+            extra.update(self._tray_fields(ams_num, tray_num))
 
         spool_data = {
             "filament_id": filament_id,
@@ -243,17 +397,17 @@ class SpoolmanClient:
         }
 
         try:
-            response = requests.post(
-                self._make_api_route("spool"),
-                json=spool_data,
-                verify=self.verify,
+            response = self._request(
+                "POST", self._make_api_route("spool"), json=spool_data
             )
 
             response.raise_for_status()
 
             logger.info(f"Created spool with filament_id {filament_id}")
 
-            return response.json()
+            spool = response.json()
+            self._mirror_spool(spool)
+            return spool
         except Exception as e:
             logger.error(f"Exception creating spool: {e}")
             return None
@@ -273,96 +427,31 @@ class SpoolmanClient:
             logger.debug("No external filaments available")
             return None
 
-        filament_type = tray_data.get("tray_type", "")
-        filament_sub_brand = tray_data.get("tray_sub_brands", "")
-
-        # Extract colors from cols array (supports multi-color filaments)
-        cols = tray_data.get("cols", [])
-        if cols:
-            # Use cols array if available
-            color_hexes = [col[:6].upper() for col in cols]
-        else:
-            # Fall back to tray_color for backwards compatibility
-            tray_color = tray_data.get("tray_color", "")
-            color_hexes = [tray_color[:6].upper()] if tray_color else []
-
-        # Step 1: Filter by Bambu Lab manufacturer/vendor
-        bambu_filaments = []
-        for filament in external_filaments:
-            manufacturer = filament.get("manufacturer", "")
-            # Handle both dict and string manufacturer
-            if isinstance(manufacturer, dict):
-                manufacturer_name = manufacturer.get("name", "")
-            elif isinstance(manufacturer, str):
-                manufacturer_name = manufacturer
-            else:
-                manufacturer_name = ""
-
-            if "bambu" in manufacturer_name.lower():
-                bambu_filaments.append(filament)
-
-        if not bambu_filaments:
-            logger.debug("No Bambu Lab filaments found in external database")
-            return None
-
-        # Step 2: Filter by color (using intersection - any color match)
-        color_matched = []
-        for filament in bambu_filaments:
-            # Handle both color_hex (single) and color_hexes (multiple)
-            filament_colors = filament.get("color_hex") or filament.get("color_hexes")
-
-            # Convert to list if single value
-            if isinstance(filament_colors, str):
-                filament_colors = [filament_colors]
-            elif filament_colors is None:
-                filament_colors = []
-
-            # Check if any color from tray matches any color from filament (intersection)
-            if any(color in filament_colors for color in color_hexes):
-                color_matched.append(filament)
-
-        if not color_matched:
-            logger.debug(f"No color match found for {color_hexes}")
-            return None
-
-        # Step 3: Try to match by sub_brand/specific name (e.g., "PETG HF")
-        if filament_sub_brand and filament_sub_brand.strip():
-            sub_brands = [
-                filament_sub_brand.replace(" ", "_").lower(),
-                filament_sub_brand.replace(" ", "+").lower(),
-                filament_sub_brand.replace(" ", "-").lower(),
-            ]
-
-            for filament in color_matched:
-                filament_id = filament.get("id", "").lower()
-                for brand in sub_brands:
-                    if brand in filament_id:
-                        logger.info(
-                            f"Found exact sub-brand match: {filament.get('name')} (id: {filament_id})"
-                        )
-                        return filament
-
-        # Step 4: Filter by material type (fallback)
-        for filament in color_matched:
-            filament_material = filament.get("material", "").upper()
-            if filament_material == filament_type.upper():
-                logger.info(
-                    f"Found material type match: {filament.get('name')} (id: {filament.get('id')})"
-                )
-                return filament
-
-        logger.debug(
-            f"No external filament match for {filament_sub_brand} ({filament_type}) with color {color_hexes}"
-        )
-        return None
+        # Rebuild the index whenever the cached listing is replaced
+        index = self._external_filament_index
+        if index is None or index.filaments is not external_filaments:
+            index = ExternalFilamentIndex(external_filaments, self.color_match_distance)
+            self._external_filament_index = index
+        return index.match(tray_data)
 
     def create_filament_from_external(self, external_filament, tray_material=None):
         """
         Creates a filament from an external filament definition
         tray_material: Optional material from tray (e.g. "PLA Matte") to preserve full variant
         Returns the created filament or None on failure
+        Reuses the filament previously created from the same external filament
         """
         try:
+            if external_id := external_filament.get("id"):
+                existing = self._catalog_lookup(self.catalog.filament, external_id)
+                if existing is not None:
+                    logger.info(
+                        "Reusing filament {} for external filament {}",
+                        existing.get("id"),
+                        external_id,
+                    )
+                    return existing
+
             # Get or create the vendor
             manufacturer = external_filament.get("manufacturer", {})
             # Handle both dict and string manufacturer
@@ -416,15 +505,15 @@ class SpoolmanClient:
                 # Default to black if no color specified
                 filament_data["color_hex"] = "000000"
 
-            response = requests.post(
-                self._make_api_route("filament"),
-                json=filament_data,
-                verify=self.verify,
+            response = self._request(
+                "POST", self._make_api_route("filament"), json=filament_data
             )
             response.raise_for_status()
 
             logger.info(f"Created filament from external: {filament_data['name']}")
-            return response.json()
+            filament = response.json()
+            self.catalog.add_filament(filament)
+            return filament
         except requests.exceptions.HTTPError as e:
             logger.error(
                 f"HTTP error creating filament from external: status={e.response.status_code}, response={e.response.text}"
@@ -434,7 +523,7 @@ class SpoolmanClient:
             logger.error(f"Exception creating filament from external: {e}")
             return None
 
-    def auto_create_spool_from_tray(self, tray_data):
+    def auto_create_spool_from_tray(self, tray_data, ams_num=None, tray_num=None):
         """
         Automatically creates a spool from tray data
         First tries to match with external filaments, then falls back to basic creation
@@ -477,7 +566,9 @@ class SpoolmanClient:
             return None
 
         # Create the spool with the tray UUID
-        spool = self.create_spool(filament["id"], tray_uuid, weight_int)
+        spool = self.create_spool(
+            filament["id"], tray_uuid, weight_int, ams_num, tray_num
+        )
         return spool
 
     def _get_or_create_vendor(self, vendor_name):
@@ -486,38 +577,360 @@ class SpoolmanClient:
         """
         try:
             # Try to find existing vendor
-            response = requests.get(self._make_api_route("vendor"), verify=self.verify)
-            response.raise_for_status()
-            vendors = response.json()
-            for vendor in vendors:
-                if vendor.get("name") == vendor_name:
-                    return vendor
+            vendor = self._catalog_lookup(self.catalog.vendor, vendor_name)
+            if vendor is not None:
+                return vendor
 
             # Vendor not found, create it
             vendor_data = {
                 "name": vendor_name,
                 "empty_spool_weight": 250,
             }
-            response = requests.post(
-                self._make_api_route("vendor"),
-                json=vendor_data,
-                verify=self.verify,
+            response = self._request(
+                "POST", self._make_api_route("vendor"), json=vendor_data
             )
             response.raise_for_status()
 
             logger.info(f"Created vendor: {vendor_name}")
-            return response.json()
+            vendor = response.json()
+            self.catalog.add_vendor(vendor)
+            return vendor
         except Exception as e:
             logger.error(f"Exception in _get_or_create_vendor: {e}")
             return None
 
+    def refresh_catalog(self):
+        """
+        Replaces the contents of the catalog mirror with the vendors and
+        filaments in Spoolman
+        """
+        vendors = self._request("GET", self._make_api_route("vendor"))
+        vendors.raise_for_status()
+        filaments = self._request("GET", self._make_api_route("filament"))
+        filaments.raise_for_status()
+        self.catalog.replace(vendors.json(), filaments.json())
+        logger.debug("Refreshed catalog mirror")
+
+    def _catalog_lookup(self, lookup, key):
+        """
+        Looks up a vendor or filament in the catalog mirror
+
+        The mirror is only listed before the lookup the first time and when it
+        doesn't know about the key. Otherwise an out of date mirror is
+        refreshed in the background, unless the change feed keeps it current.
+        """
+        with self._catalog_lock:
+            if self.catalog.refreshed_at is None:
+                self.refresh_catalog()
+            elif (
+                self.catalog.age() > self.mirror_interval
+                and not self._change_feed_live()
+            ):
+                self._refresh_catalog_in_background()
+            value = lookup(key)
+            if value is None and self.catalog.age() > MIRROR_MISS_REFRESH_SECONDS:
+                # It may have been created in Spoolman since the last refresh
+                self.refresh_catalog()
+                value = lookup(key)
+            return value
+
+    def _refresh_catalog_in_background(self):
+        if self._catalog_thread is not None and self._catalog_thread.is_alive():
+            return
+        self._catalog_thread = threading.Thread(
+            target=self._refresh_catalog_quietly, name="CatalogMirror", daemon=True
+        )
+        self._catalog_thread.start()
+
+    def _refresh_catalog_quietly(self):
+        try:
+            self.refresh_catalog()
+        except Exception as e:
+            logger.warning("Failed to refresh catalog mirror: {}", e)
+
+    def _current_spool(self, spool_id):
+        """
+        Returns the current version of a spool, from the mirror if it was just
+        fetched or written
+        """
+        spool = self.mirror.get(spool_id, max_age=FRESH_SPOOL_SECONDS)
+        if spool is not None:
+            return spool
+        return self.get_spool(spool_id)
+
+    def _mirror_spool(self, spool):
+        """
+        Writes a spool returned by Spoolman through to the spool mirror
+        """
+        if spool.get("archived"):
+            # The mirror holds the same spools as a default listing
+            self.mirror.remove(spool["id"])
+        else:
+            self.mirror.update(spool)
+
+    def _load_mirror(self):
+        """
+        Loads the spool mirror on first use and starts refreshing it
+        periodically
+        """
+        if self.mirror.loaded and self._mirror_thread is not None:
+            return
+        with self._mirror_lock:
+            if not self.mirror.loaded:
+                self.refresh_mirror()
+            self._start_mirror_refresh()
+
+    def _start_mirror_refresh(self):
+        if self._mirror_thread is None:
+            self._mirror_thread = threading.Thread(
+                target=self._refresh_mirror_periodically,
+                name="SpoolMirror",
+                daemon=True,
+            )
+            self._mirror_thread.start()
+
+    def _refresh_mirror_periodically(self):
+        while True:
+            time.sleep(self.mirror_interval)
+            if self._change_feed_live():
+                # The change feed keeps the mirror up to date
+                continue
+            try:
+                self.refresh_mirror()
+            except Exception as e:
+                logger.warning("Failed to refresh spool mirror: {}", e)
+
+    def start_change_feed(self):
+        """
+        Starts applying the changes published by Spoolman to the spool and
+        catalog mirrors
+        """
+        self.change_feed = SpoolmanChangeFeed(self)
+        self.change_feed.start()
+        # Falls back to refreshing the mirror while the feed is down
+        with self._mirror_lock:
+            self._start_mirror_refresh()
+
+    def _change_feed_live(self):
+        return self.change_feed is not None and self.change_feed.live
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """
+        Limits the requests made by this thread in the block to ``seconds`` in
+        total, for example the time left to answer a gRPC call. Timeouts are
+        shortened to fit and requests past the deadline raise DeadlineExceeded.
+        Nested deadlines can only shorten the outer one. None sets no limit.
+        """
+        previous = getattr(_deadlines, "expires", None)
+        expires = previous
+        if seconds is not None:
+            expires = time.monotonic() + seconds
+            if previous is not None:
+                expires = min(expires, previous)
+        _deadlines.expires = expires
+        try:
+            yield
+        finally:
+            _deadlines.expires = previous
+
+    def _request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session and records its latency
+
+        Requests are refused with CircuitOpenError while the circuit breaker is
+        open. Connection errors, timeouts and server errors count towards
+        opening it, except for timeouts caused by the caller's deadline. Under
+        a deadline, a failed attempt is only retried if the retry can complete
+        before it.
+        """
+        timeout = kwargs.pop("timeout", self.timeout)
+        endpoint = f"{method} {_endpoint_name(self.endpoint, url)}"
+
+        shortened = False
+        expires = getattr(_deadlines, "expires", None)
+        if expires is not None:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                metrics.increment(f"spoolman.deadline_exceeded.{endpoint}")
+                raise DeadlineExceeded(f"No time left for {endpoint}")
+            shortened = remaining < max(timeout)
+            timeout = tuple(min(t, remaining) for t in timeout)
+        _deadlines.attempt_timeout = max(timeout)
+
+        try:
+            self.breaker.acquire()
+        except CircuitOpenError:
+            metrics.increment(f"spoolman.rejected.{endpoint}")
+            raise
+
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.increment(f"spoolman.errors.{endpoint}")
+            if shortened and time.monotonic() >= expires:
+                # Ran out of the caller's time, Spoolman may still be healthy
+                self.breaker.release()
+            else:
+                self.breaker.failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            metrics.observe(
+                f"spoolman.latency_seconds.{endpoint}", time.monotonic() - started
+            )
+
+        if response.status_code >= 500:
+            metrics.increment(f"spoolman.errors.{endpoint}")
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
     def _make_api_route(self, route, **kwargs):
-        query_string = "&".join([f"{k}={v}" for k, v in kwargs.items()])
+        query_string = urlencode(kwargs)
         if query_string:
             return f"{self.endpoint}/api/v1/{route}?{query_string}"
         return f"{self.endpoint}/api/v1/{route}"
 
 
+class AsyncSpoolmanClient:
+    """
+    An asyncio interface to a SpoolmanClient
+
+    Every call runs on a thread pool as large as the client's connection pool,
+    so a slow Spoolman never blocks the event loop and concurrent calls are
+    sent on separate connections instead of queueing behind each other. Calls
+    accept a timeout, such as the time left to answer a gRPC call, that
+    bounds all the requests they make.
+    """
+
+    def __init__(self, client: SpoolmanClient):
+        self.client = client
+        self._executor = ThreadPoolExecutor(
+            max_workers=client.pool_size, thread_name_prefix="spoolman"
+        )
+
+    @property
+    def endpoint(self):
+        return self.client.endpoint
+
+    def supports_tray_locking(self):
+        return self.client.supports_tray_locking()
+
+    async def validate(self, timeout=None):
+        return await self._call(self.client.validate, timeout=timeout)
+
+    async def get_info(self, timeout=None):
+        return await self._call(self.client.get_info, timeout=timeout)
+
+    async def get_spools(self, use_cache=False, timeout=None):
+        return await self._call(self.client.get_spools, use_cache, timeout=timeout)
+
+    async def get_spool(self, spool_id, use_cache=False, timeout=None):
+        return await self._call(
+            self.client.get_spool, spool_id, use_cache, timeout=timeout
+        )
+
+    async def lookup_by_tray_uuid(self, tray_uuid, timeout=None):
+        return await self._call(
+            self.client.lookup_by_tray_uuid, tray_uuid, timeout=timeout
+        )
+
+    async def lookup_by_tray(self, ams_num, tray_num, timeout=None):
+        return await self._call(
+            self.client.lookup_by_tray, ams_num, tray_num, timeout=timeout
+        )
+
+    async def set_tray_uuid(
+        self, spool_id, tray_uuid, ams_num=None, tray_num=None, timeout=None
+    ):
+        return await self._call(
+            self.client.set_tray_uuid,
+            spool_id,
+            tray_uuid,
+            ams_num,
+            tray_num,
+            timeout=timeout,
+        )
+
+    async def set_active_tray(
+        self, spool_id, ams_num=None, tray_num=None, timeout=None
+    ):
+        return await self._call(
+            self.client.set_active_tray, spool_id, ams_num, tray_num, timeout=timeout
+        )
+
+    async def _call(self, func, *args, timeout=None):
+        """
+        Runs a call on the thread pool within ``timeout`` seconds from now,
+        including the time spent waiting for a thread
+        """
+        expires = None if timeout is None else time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._run, expires, func, *args)
+        )
+
+    def _run(self, expires, func, *args):
+        timeout = None if expires is None else expires - time.monotonic()
+        with self.client.deadline(timeout):
+            return func(*args)
+
+
+# The deadline of the calling thread and the timeout of its current attempt
+_deadlines = threading.local()
+
+
+class _DeadlineRetry(Retry):
+    """
+    Retries that are only made if they can complete before the deadline of the
+    calling thread, including the backoff before them
+    """
+
+    def is_exhausted(self):
+        if super().is_exhausted():
+            return True
+        expires = getattr(_deadlines, "expires", None)
+        if expires is None:
+            return False
+        remaining = expires - time.monotonic()
+        return remaining < self.get_backoff_time() + _deadlines.attempt_timeout
+
+
+def _new_session(verify, pool_size, retries):
+    session = requests.Session()
+    session.verify = verify
+
+    # Only calls that can safely be repeated are retried. Consuming filament
+    # (PUT spool/{id}/use) and creating records must never be sent twice. A
+    # read timeout is retried once at most, as a hung Spoolman is unlikely to
+    # recover within the next attempt.
+    retry = _DeadlineRetry(
+        total=retries,
+        read=min(retries, 1),
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _endpoint_name(base_url, url):
+    """
+    Returns the API route of a URL with the ids replaced, e.g. spool/{id}/use
+    """
+    route = url.removeprefix(f"{base_url}/api/v1/").split("?", 1)[0]
+    return "/".join("{id}" if part.isdigit() else part for part in route.split("/"))
+
+
 def new_client(url=None) -> SpoolmanClient:
     """
     Create a new Spoolman client
@@ -538,3 +951,16 @@ def instance():
     if spoolman_client_instance is None:
         spoolman_client_instance = new_client()
     return spoolman_client_instance
+
+
+async_spoolman_client_instance = None
+
+
+def async_instance() -> AsyncSpoolmanClient:
+    """
+    Gets a singleton asyncio interface to the Spoolman client.
+    """
+    global async_spoolman_client_instance
+    if async_spoolman_client_instance is None:
+        async_spoolman_client_instance = AsyncSpoolmanClient(instance())
+    return async_spoolman_client_instance
@@ -0,0 +1,133 @@
+import json
+import ssl
+import threading
+
+import websocket
+from loguru import logger
+
+DEFAULT_RECONNECT_INTERVAL = 10
+
+# Seconds without a message before the connection is checked with a ping
+IDLE_TIMEOUT = 60
+
+# Seconds to wait for any reply to a ping before dropping the connection
+PONG_TIMEOUT = 10
+
+
+class SpoolmanChangeFeed:
+    """
+    Applies the changes Spoolman publishes over its websockets to the client's
+    spool and catalog mirrors
+
+    Spools and filaments are each watched over their own connection. Changes
+    made while a connection is down are missed, so the mirrors are fully
+    refreshed after every (re)connect, and the client keeps refreshing them
+    periodically for as long as the feed isn't live. A connection only counts
+    as live once that refresh is done, and is dropped if it doesn't answer a
+    ping after being idle.
+    """
+
+    RESOURCES = ("spool", "filament")
+
+    def __init__(self, client, reconnect_interval=DEFAULT_RECONNECT_INTERVAL):
+        self.client = client
+        self.reconnect_interval = reconnect_interval
+
+        self._connected = set()
+        self._stopped = threading.Event()
+
+    @property
+    def live(self):
+        """
+        Whether every resource is being watched
+        """
+        return self._connected.issuperset(self.RESOURCES)
+
+    def start(self):
+        for resource in self.RESOURCES:
+            threading.Thread(
+                target=self._run,
+                args=(resource,),
+                name=f"SpoolmanFeed-{resource}",
+                daemon=True,
+            ).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, resource):
+        while not self._stopped.is_set():
+            try:
+                self._watch(resource)
+            except Exception as e:
+                logger.warning("Spoolman {} feed disconnected: {}", resource, e)
+            self._stopped.wait(self.reconnect_interval)
+
+    def _watch(self, resource):
+        url = self._url(resource)
+        sslopt = None if self.client.verify else {"cert_reqs": ssl.CERT_NONE}
+        ws = websocket.create_connection(url, timeout=IDLE_TIMEOUT, sslopt=sslopt)
+        try:
+            self._resync(resource)
+            logger.info("Watching Spoolman for {} changes", resource)
+            self._connected.add(resource)
+
+            awaiting_pong = False
+            while not self._stopped.is_set():
+                try:
+                    opcode, data = ws.recv_data(control_frame=True)
+                except websocket.WebSocketTimeoutException:
+                    if awaiting_pong:
+                        raise ConnectionError("no reply to ping")
+                    ws.ping()
+                    ws.settimeout(PONG_TIMEOUT)
+                    awaiting_pong = True
+                    continue
+
+                if awaiting_pong:
+                    # Anything received shows the connection is still up
+                    ws.settimeout(IDLE_TIMEOUT)
+                    awaiting_pong = False
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise ConnectionError("connection closed")
+                if opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+                    self._apply(json.loads(data))
+        finally:
+            self._connected.discard(resource)
+            # Closed without the closing handshake, which a dead connection
+            # would never answer
+            ws.shutdown()
+
+    def _resync(self, resource):
+        if resource == "spool":
+            self.client.refresh_mirror()
+        else:
+            self.client.refresh_catalog()
+
+    def _apply(self, event):
+        resource = event.get("resource")
+        change = event.get("type")
+        payload = event.get("payload")
+        if not isinstance(payload, dict) or "id" not in payload:
+            return
+        logger.debug("Spoolman {} {} {}", resource, payload["id"], change)
+
+        if resource == "spool":
+            if change == "deleted":
+                self.client.mirror.remove(payload["id"])
+            else:
+                self.client._mirror_spool(payload)
+        elif resource == "filament":
+            if change == "deleted":
+                self.client.catalog.remove_filament(payload)
+            else:
+                self.client.catalog.add_filament(payload)
+                self.client.mirror.update_filament(payload)
+
+    def _url(self, resource):
+        endpoint = self.client.endpoint
+        if endpoint.startswith("https://"):
+            endpoint = "wss://" + endpoint.removeprefix("https://")
+        elif endpoint.startswith("http://"):
+            endpoint = "ws://" + endpoint.removeprefix("http://")
+        return f"{endpoint}/api/v1/{resource}"
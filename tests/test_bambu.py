@@ -0,0 +1,76 @@
+import io
+import zipfile
+
+import pytest
+
+from bambu_spoolman.gcode.bambu import evaluate_model, evaluate_model_stream
+
+PLATE_GCODE = {
+    "Metadata/plate_1.gcode": "M620 S0A\nG1 E1\nM73 L1\nG1 E2\n",
+    "Metadata/plate_2.gcode": "M620 S1A\nG1 E5\nM73 L1\nG1 E6\n",
+}
+
+
+def model_settings(*gcode_files):
+    plates = "".join(
+        f'<plate><metadata key="plater_id" value="{number}"/>'
+        f'<metadata key="gcode_file" value="{gcode_file}"/></plate>'
+        for number, gcode_file in enumerate(gcode_files, 1)
+    )
+    return f'<?xml version="1.0"?><config>{plates}</config>'
+
+
+def make_model(settings, settings_first):
+    members = list(PLATE_GCODE.items())
+    if settings is not None:
+        member = ("Metadata/model_settings.config", settings)
+        members.insert(0 if settings_first else len(members), member)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def stream(data):
+    def produce(write):
+        for i in range(0, len(data), 64):
+            write(data[i : i + 64])
+
+    return evaluate_model_stream(produce)
+
+
+@pytest.fixture(autouse=True)
+def config_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("BAMBU_SPOOLMAN_CONFIG", str(tmp_path))
+
+
+@pytest.mark.parametrize("settings_first", [True, False])
+@pytest.mark.parametrize(
+    "settings, expected",
+    [
+        (model_settings("", "/Metadata/plate_2.gcode"), {0: {1: 5.0}, 1: {1: 6.0}}),
+        (model_settings("/Metadata/plate_1.gcode"), {0: {0: 1.0}, 1: {0: 2.0}}),
+        (model_settings(""), None),
+        (None, None),
+    ],
+    ids=["second_plate", "first_plate", "no_gcode", "no_settings"],
+)
+def test_stream_selects_the_same_plate(settings, expected, settings_first):
+    data = make_model(settings, settings_first)
+
+    assert evaluate_model(io.BytesIO(data)) == expected
+    assert stream(data) == expected
+
+
+def test_stream_with_gcode_path():
+    data = make_model(model_settings("/Metadata/plate_1.gcode"), False)
+
+    def produce(write):
+        write(data)
+
+    assert evaluate_model_stream(produce, "/Metadata/plate_2.gcode") == {
+        0: {1: 5.0},
+        1: {1: 6.0},
+    }
@@ -0,0 +1,64 @@
+import os
+import zipfile
+
+import pytest
+
+from bambu_spoolman.gcode import cache
+
+
+@pytest.fixture(autouse=True)
+def config_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("BAMBU_SPOOLMAN_CONFIG", str(tmp_path))
+
+
+def gcode_info(filename="Metadata/plate_1.gcode", crc=0x1234, size=100):
+    info = zipfile.ZipInfo(filename)
+    info.CRC = crc
+    info.file_size = size
+    return info
+
+
+def test_cache_key_identifies_the_member():
+    key = cache.cache_key(gcode_info())
+
+    assert cache.cache_key(gcode_info()) == key
+    assert cache.cache_key(gcode_info(filename="Metadata/plate_2.gcode")) != key
+    assert cache.cache_key(gcode_info(crc=0x4321)) != key
+    assert cache.cache_key(gcode_info(size=101)) != key
+
+
+def test_usage_round_trip():
+    usage = {0: {0: 1.5}, 3: {1: 2.0, 2: 0.25}}
+    cache.save_usage("key", usage)
+
+    assert cache.load_usage("key") == usage
+    assert cache.load_usage("other") is None
+
+
+def test_unreadable_entry_is_discarded():
+    path = os.path.join(cache.cache_directory(), "key.json")
+    with open(path, "w") as f:
+        f.write("{not json")
+
+    assert cache.load_usage("key") is None
+    assert not os.path.exists(path)
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    usage = {layer: {0: 1.0} for layer in range(50)}
+    cache.save_usage("first", usage)
+    entry_size = os.path.getsize(os.path.join(cache.cache_directory(), "first.json"))
+    # Room for two entries
+    monkeypatch.setenv(
+        "BAMBU_SPOOLMAN_CACHE_SIZE_MB", str(2.5 * entry_size / 1024 / 1024)
+    )
+    cache.save_usage("second", usage)
+
+    # Using the first entry makes the second one the least recently used
+    os.utime(os.path.join(cache.cache_directory(), "second.json"), (1, 1))
+    assert cache.load_usage("first") is not None
+    cache.save_usage("third", usage)
+
+    assert cache.load_usage("second") is None
+    assert cache.load_usage("first") is not None
+    assert cache.load_usage("third") is not None
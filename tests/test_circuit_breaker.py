@@ -0,0 +1,96 @@
+import pytest
+
+from bambu_spoolman import circuit_breaker
+from bambu_spoolman.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def open_breaker(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    for _ in range(3):
+        breaker.acquire()
+        breaker.failure()
+    return breaker
+
+
+def test_closed_below_threshold(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    for _ in range(2):
+        breaker.acquire()
+        breaker.failure()
+    assert not breaker.open
+    breaker.acquire()
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert not breaker.open
+    assert breaker.succeeded_at == clock[0]
+
+
+def test_opens_at_threshold(clock):
+    breaker = open_breaker(clock)
+    assert breaker.open
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+    clock[0] += 9
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_single_probe_after_reset_timeout(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 10
+    assert not breaker.open
+
+    breaker.acquire()
+    assert breaker.open
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 10
+    breaker.acquire()
+    breaker.failure()
+
+    assert breaker.open
+    clock[0] += 9
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    clock[0] += 1
+    breaker.acquire()
+
+
+def test_successful_probe_closes(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 10
+    breaker.acquire()
+    breaker.success()
+
+    assert not breaker.open
+    breaker.acquire()
+    breaker.acquire()
+
+
+def test_released_probe_allows_another(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 10
+    breaker.acquire()
+    breaker.release()
+
+    assert not breaker.open
+    breaker.acquire()
@@ -0,0 +1,197 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from bambu_spoolman.broker.consumption_aggregator import ConsumptionAggregator
+from bambu_spoolman.broker.consumption_journal import ConsumptionJournal
+
+
+class FakeSpoolman:
+    def __init__(self):
+        self.consumed = []
+        self.error = None
+        self.sent = threading.Event()
+
+    def consume_spool(self, spool_id, *, length=None, weight=None):
+        if self.error is not None:
+            raise self.error
+        self.consumed.append((spool_id, length))
+        self.sent.set()
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def journal_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "consumption.jsonl")
+
+
+def test_batches_usage_per_spool(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    aggregator.add(2, 5)
+    aggregator.add(1, 2.5)
+
+    assert spoolman.consumed == []
+    assert aggregator.pending() == {1: 12.5, 2: 5}
+
+    aggregator.flush()
+
+    assert sorted(spoolman.consumed) == [(1, 12.5), (2, 5)]
+    assert aggregator.pending() == {}
+
+
+def test_usage_is_journaled_before_it_is_sent(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+
+    assert [(r["spool_id"], r["length"]) for r in journal_records(journal_path)] == [
+        (1, 10)
+    ]
+
+
+def test_acknowledged_usage_is_compacted_away(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    aggregator.add(2, 5)
+    aggregator.flush()
+
+    assert journal_records(journal_path) == []
+
+
+def test_failed_usage_is_retried(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    spoolman.error = requests.ConnectionError("Spoolman is down")
+    aggregator.flush()
+
+    assert aggregator.pending() == {1: 10}
+    assert len(journal_records(journal_path)) == 1
+
+    aggregator.add(1, 5)
+    spoolman.error = None
+    aggregator.flush()
+
+    assert spoolman.consumed == [(1, 15)]
+    assert journal_records(journal_path) == []
+
+
+def test_server_errors_are_retried(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    spoolman.error = http_error(503)
+    aggregator.flush()
+
+    assert aggregator.pending() == {1: 10}
+
+
+def test_rejected_usage_is_dropped(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    spoolman.error = http_error(404)
+    aggregator.flush()
+
+    assert aggregator.pending() == {}
+    assert journal_records(journal_path) == []
+
+
+def test_unsent_usage_is_replayed_after_restart(journal_path):
+    spoolman = FakeSpoolman()
+    spoolman.error = requests.ConnectionError("Spoolman is down")
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.add(1, 10)
+    aggregator.add(1, 5)
+    aggregator.add(2, 1)
+    # The daemon stops without reaching Spoolman
+    aggregator.stop()
+
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, journal=ConsumptionJournal(journal_path)
+    )
+    assert aggregator.pending() == {1: 15, 2: 1}
+
+    aggregator.flush()
+
+    assert sorted(spoolman.consumed) == [(1, 15), (2, 1)]
+    assert journal_records(journal_path) == []
+
+
+def test_incomplete_record_is_skipped(journal_path):
+    journal = ConsumptionJournal(journal_path)
+    journal.append(1, 10)
+    journal.close()
+    with open(journal_path, "a") as f:
+        f.write('{"key": "abc", "spool_')
+
+    journal = ConsumptionJournal(journal_path)
+
+    assert [(r["spool_id"], r["length"]) for r in journal.pending()] == [(1, 10)]
+    assert len(journal_records(journal_path)) == 1
+
+
+def test_zero_interval_sends_every_addition(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman, interval=0, journal=ConsumptionJournal(journal_path)
+    )
+    aggregator.start()
+    try:
+        aggregator.add(1, 10)
+        assert spoolman.sent.wait(5)
+    finally:
+        aggregator.stop()
+
+    assert spoolman.consumed == [(1, 10)]
+    assert journal_records(journal_path) == []
+
+
+def test_threshold_sends_early(journal_path):
+    spoolman = FakeSpoolman()
+    aggregator = ConsumptionAggregator(
+        spoolman,
+        interval=3600,
+        threshold=100,
+        journal=ConsumptionJournal(journal_path),
+    )
+    aggregator.start()
+    try:
+        aggregator.add(1, 50)
+        assert not spoolman.sent.wait(0.3)
+        aggregator.add(1, 50)
+        assert spoolman.sent.wait(5)
+    finally:
+        aggregator.stop()
+
+    assert spoolman.consumed == [(1, 100)]
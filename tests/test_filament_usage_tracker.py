@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+
+import pytest
+from loguru import logger
+
+from bambu_spoolman.broker import filament_usage_tracker
+from bambu_spoolman.broker.filament_usage_tracker import FilamentUsageTracker
+
+LAYER_USAGE = {0: {0: 1.0}, 1: {0: 2.0}, 2: {0: 3.0}, 3: {0: 4.0}}
+
+
+class FakeConsumption:
+    def __init__(self, errors=()):
+        self.added = []
+        self.errors = list(errors)
+
+    def add(self, spool_id, length):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.added.append((spool_id, length))
+
+    def flush_soon(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def config_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("BAMBU_SPOOLMAN_CONFIG", str(tmp_path))
+    with open(tmp_path / "settings.json", "w") as f:
+        json.dump({"trays": {"255": 7}}, f)
+
+
+@pytest.fixture
+def messages():
+    messages = []
+    handler = logger.add(lambda message: messages.append(message.record["message"]))
+    yield messages
+    logger.remove(handler)
+
+
+def push_status(tracker, **fields):
+    tracker.on_message(None, {"print": {"command": "push_status", **fields}})
+
+
+def start_print(tracker, monkeypatch):
+    """
+    Starts a print whose model is only evaluated once the returned event is set
+    """
+    release = threading.Event()
+
+    def evaluate(*args):
+        release.wait(5)
+        return LAYER_USAGE
+
+    monkeypatch.setattr(tracker, "_evaluate_print_start_model", evaluate)
+    tracker.on_message(
+        None,
+        {"print": {"command": "project_file", "url": "ftp://model.3mf", "param": ""}},
+    )
+    return release
+
+
+def wait_for_load(tracker):
+    deadline = time.monotonic() + 5
+    while tracker._is_loading():
+        assert time.monotonic() < deadline, "Model load didn't finish"
+        time.sleep(0.01)
+
+
+def test_layers_queued_during_load_are_spent(monkeypatch):
+    consumption = FakeConsumption()
+    tracker = FilamentUsageTracker(consumption)
+
+    release = start_print(tracker, monkeypatch)
+    for layer in (1, 2, 3):
+        push_status(tracker, layer_num=layer)
+    release.set()
+    wait_for_load(tracker)
+
+    assert tracker.current_layer == 3
+    assert consumption.added == [(7, 3.0), (7, 4.0)]
+
+
+def test_failed_spend_does_not_drop_later_layers(monkeypatch, messages):
+    consumption = FakeConsumption([OSError("Disk full")])
+    tracker = FilamentUsageTracker(consumption)
+
+    release = start_print(tracker, monkeypatch)
+    for layer in (1, 2, 3):
+        push_status(tracker, layer_num=layer)
+    release.set()
+    wait_for_load(tracker)
+
+    assert tracker.active_model is not None
+    assert tracker.current_layer == 3
+    assert consumption.added == [(7, 4.0)]
+    assert "Model load was cancelled" not in messages
+
+
+def test_error_after_activation_is_not_a_failed_load(monkeypatch, messages):
+    consumption = FakeConsumption([RuntimeError("Unexpected")])
+    tracker = FilamentUsageTracker(consumption)
+
+    release = start_print(tracker, monkeypatch)
+    for layer in (1, 2):
+        push_status(tracker, layer_num=layer)
+    release.set()
+    wait_for_load(tracker)
+    # The load thread logs the error after the model became active
+    time.sleep(0.1)
+
+    assert tracker.active_model is not None
+    assert "Model load was cancelled" not in messages
+
+
+def test_failed_checkpoint_still_tracks_the_print(monkeypatch):
+    def save_checkpoint(**kwargs):
+        raise OSError("Read-only file system")
+
+    monkeypatch.setattr(filament_usage_tracker, "save_checkpoint", save_checkpoint)
+    consumption = FakeConsumption()
+    tracker = FilamentUsageTracker(consumption)
+
+    start_print(tracker, monkeypatch).set()
+    wait_for_load(tracker)
+    push_status(tracker, layer_num=1)
+    push_status(tracker, layer_num=2)
+
+    assert tracker.active_model is not None
+    assert consumption.added == [(7, 3.0)]
+
+
+def test_failed_evaluation_clears_the_load(monkeypatch):
+    tracker = FilamentUsageTracker(FakeConsumption())
+
+    def evaluate(*args):
+        raise ValueError("Corrupt model")
+
+    monkeypatch.setattr(tracker, "_evaluate_print_start_model", evaluate)
+    tracker.on_message(
+        None,
+        {"print": {"command": "project_file", "url": "ftp://model.3mf", "param": ""}},
+    )
+    wait_for_load(tracker)
+
+    assert tracker.active_model is None
+    assert tracker._pending_layers == []
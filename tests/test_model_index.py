@@ -0,0 +1,98 @@
+import io
+import zipfile
+
+import pytest
+
+from bambu_spoolman.gcode import model_index
+from bambu_spoolman.gcode.model_index import (
+    build_model_index,
+    index_key,
+    load_model_index,
+)
+
+MODEL_SETTINGS = (
+    '<?xml version="1.0"?><config>'
+    '<plate><metadata key="gcode_file" value=""/></plate>'
+    '<plate><metadata key="gcode_file" value="/Metadata/plate_2.gcode"/></plate>'
+    "</config>"
+)
+
+SLICE_INFO = (
+    '<?xml version="1.0"?><config>'
+    '<plate><metadata key="index" value="2"/>'
+    '<filament id="1" used_m="1.5" used_g="4.5"/></plate>'
+    "</config>"
+)
+
+
+def make_model(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+def full_model(gcode=b"G1 E1\n"):
+    return make_model(
+        {
+            "Metadata/plate_10.gcode": b"G1 E3\n",
+            "Metadata/plate_2.gcode": gcode,
+            "Metadata/plate_2.gcode.md5": b"abc",
+            "Metadata/model_settings.config": MODEL_SETTINGS,
+            "Metadata/slice_info.config": SLICE_INFO,
+        }
+    )
+
+
+@pytest.fixture(autouse=True)
+def config_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("BAMBU_SPOOLMAN_CONFIG", str(tmp_path))
+
+
+def test_plates_in_plate_order():
+    index = build_model_index(full_model())
+
+    assert [plate.number for plate in index.plates.values()] == [2, 10]
+    assert index.default_plate == "Metadata/plate_2.gcode"
+
+
+def test_plate_lookup():
+    index = build_model_index(full_model())
+
+    assert index.plate().number == 2
+    assert index.plate("/Metadata/plate_10.gcode").number == 10
+    assert index.plate("Metadata/plate_3.gcode") is None
+
+
+def test_slice_totals():
+    index = build_model_index(full_model())
+
+    assert index.plate().slice_totals == {0: 1500.0}
+    assert index.plate("Metadata/plate_10.gcode").slice_totals is None
+
+
+def test_without_metadata():
+    index = build_model_index(make_model({"Metadata/plate_1.gcode": b"G1 E1\n"}))
+
+    assert index.plate() is None
+    assert index.plate("Metadata/plate_1.gcode").slice_totals is None
+
+
+def test_index_key_follows_the_archive():
+    assert index_key(full_model()) == index_key(full_model())
+    assert index_key(full_model()) != index_key(full_model(b"G1 E2\n"))
+
+
+def test_index_is_persisted(monkeypatch):
+    index = load_model_index(full_model())
+
+    def build_model_index(zip_file):
+        raise AssertionError("The index should have been loaded")
+
+    monkeypatch.setattr(model_index, "build_model_index", build_model_index)
+    loaded = load_model_index(full_model())
+
+    assert loaded.as_dict() == index.as_dict()
+    assert loaded.plate().slice_totals == index.plate().slice_totals
@@ -0,0 +1,123 @@
+import io
+
+import pytest
+
+from bambu_spoolman.gcode.parser import (
+    GCodeEvaluator,
+    _iter_segments,
+    evaluate_gcode,
+    evaluate_gcode_parallel,
+)
+
+
+def reference_usage(gcode):
+    """
+    Evaluates G-code line by line, the way the original parser did
+    """
+    layer = 0
+    extrusion = {}
+    filament = None
+    layers = {}
+    for line in gcode.split("\n"):
+        line = line.split(";")[0].strip()
+        if not line:
+            continue
+        words = line.split()
+        operation = words[0]
+        params = {word[0]: word[1:] for word in words[1:]}
+
+        if operation == "M73" and params.get("L"):
+            if extrusion:
+                layers[layer] = extrusion
+                extrusion = {}
+            layer = int(params["L"])
+        elif operation == "M620" and params.get("S"):
+            value = params["S"]
+            if value in ("255", "65535"):
+                filament = None
+                continue
+            if not value[-1].isdigit():
+                value = value[:-1]
+            if int(value) > 65000:
+                continue
+            filament = int(value)
+        elif operation in ("G0", "G1", "G2", "G3") and params.get("E"):
+            if filament is not None:
+                extrusion[filament] = extrusion.get(filament, 0) + float(params["E"])
+    if extrusion:
+        layers[layer] = extrusion
+    return layers
+
+
+EDGE_CASES = {
+    "basic": "M620 S0A\nG1 X1 E1.5\nM73 L1\nG1 E2\nM73 L2\n",
+    "g10_is_not_g1": "M620 S1A\nG10 E5\nG1 E1\n",
+    "m620_1_is_not_m620": "M620 S0A\nM620.1 S3A\nG1 E1\n",
+    "repeated_e_words": "M620 S0A\nG1 E1 X2 E3\n",
+    "comments": "M620 S2A ; load\n; G1 E9\nG1 X1 ; E9\nG1 E1;x\n",
+    "indented": "  M620 S1A\n\tG1 E2\r\n   M73 L4\nG1 E0.5\n",
+    "full_unload": "M620 S0A\nG1 E1\nM620 S255\nG1 E5\nM620 S1\nG1 E2\n",
+    "bogus_filament": "M620 S0A\nM620 S65001\nG1 E1\n",
+    "m73_without_layer": "M620 S0A\nG1 E1\nM73 P50 R10\nG1 E1\n",
+    "m620_without_filament": "M620 S0A\nM620 M\nG1 E1\n",
+    "empty_e": "M620 S0A\nG1 E\nG1 E1\n",
+    "no_active_filament": "G1 E4\nM620 S0A\nG1 E1\n",
+    "arc_moves": "M620 S3A\nG2 X1 I1 E0.25\nG3 X1 J1 E0.75\nG0 E1\n",
+    "no_trailing_newline": "M620 S0A\nM73 L1\nG1 E2",
+    "negative_extrusion": "M620 S0A\nG1 E-0.8\nG1 E1.6\n",
+}
+
+
+@pytest.mark.parametrize("gcode", EDGE_CASES.values(), ids=EDGE_CASES.keys())
+def test_matches_reference(gcode):
+    assert evaluate_gcode(gcode) == reference_usage(gcode)
+
+
+@pytest.mark.parametrize("gcode", EDGE_CASES.values(), ids=EDGE_CASES.keys())
+def test_chunk_splits(gcode):
+    data = gcode.encode()
+    expected = reference_usage(gcode)
+    for split in range(len(data) + 1):
+        evaluator = GCodeEvaluator()
+        evaluator.feed(data[:split])
+        evaluator.feed(data[split:])
+        assert evaluator.finish() == expected, f"split at {split}"
+
+
+def test_byte_at_a_time():
+    gcode = "\n".join(EDGE_CASES.values())
+    assert evaluate_gcode(io.BytesIO(gcode.encode())) == reference_usage(gcode)
+    assert evaluate_gcode(bytes([b]) for b in gcode.encode()) == reference_usage(gcode)
+
+
+def make_layers(count):
+    lines = ["M620 S0A"]
+    for layer in range(1, count + 1):
+        lines.append(f"M73 L{layer}")
+        if layer % 3 == 0:
+            lines.append(f"M620 S{layer % 4}A")
+        lines.extend(f"G1 X{i} E{(layer + i) / 10}" for i in range(5))
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("segment_size", [1, 17, 64, 1000, 10**6])
+def test_segments_start_at_layer_changes(segment_size):
+    data = make_layers(40).encode()
+    chunks = [data[i : i + 50] for i in range(0, len(data), 50)]
+
+    segments = list(_iter_segments(chunks, segment_size))
+
+    assert b"".join(segments) == data
+    for segment in segments[1:]:
+        assert segment.startswith(b"M73 L")
+
+
+def test_segment_without_layer_changes():
+    data = b"M620 S0A\n" + b"G1 E1\n" * 100
+    assert list(_iter_segments([data], 10)) == [data]
+
+
+def test_parallel_matches_serial():
+    gcode = make_layers(60)
+    expected = evaluate_gcode(gcode)
+    assert evaluate_gcode_parallel(gcode, workers=2, segment_size=200) == expected
@@ -0,0 +1,126 @@
+import pytest
+
+from bambu_spoolman.spool_mirror import SpoolMirror
+
+
+def make_spool(spool_id, uuid=None, ams=None, tray=None):
+    extra = {}
+    if uuid is not None:
+        extra["tag"] = f'"{uuid}"'
+    if ams is not None:
+        extra["ams"] = f'"{ams}"'
+    if tray is not None:
+        extra["tray"] = f'"{tray}"'
+    return {"id": spool_id, "filament": {"id": 1}, "extra": extra}
+
+
+def make_mirror(*spools):
+    mirror = SpoolMirror("tag", "ams", "tray")
+    mirror.replace(spools)
+    return mirror
+
+
+def test_lookups():
+    mirror = make_mirror(make_spool(1, "aaa", 1, 2), make_spool(2, "bbb"))
+
+    assert mirror.get(1)["id"] == 1
+    assert mirror.by_uuid("bbb")["id"] == 2
+    assert mirror.by_uuid("ccc") is None
+    assert mirror.by_tray(1, 2)["id"] == 1
+    assert mirror.by_tray(1, 3) is None
+
+
+def test_cleared_tray_is_not_indexed():
+    mirror = make_mirror(make_spool(1, ams="", tray=""))
+    assert mirror.by_tray("", "") is None
+
+
+def test_update_moves_indexes():
+    mirror = make_mirror(make_spool(1, "aaa", 1, 1))
+
+    mirror.update(make_spool(1, "bbb", 2, 4))
+
+    assert mirror.by_uuid("aaa") is None
+    assert mirror.by_uuid("bbb")["id"] == 1
+    assert mirror.by_tray(1, 1) is None
+    assert mirror.by_tray(2, 4)["id"] == 1
+
+
+def test_updated_spool_takes_over_shared_tray():
+    mirror = make_mirror(make_spool(1, ams=1, tray=1), make_spool(2))
+
+    mirror.update(make_spool(2, ams=1, tray=1))
+
+    assert mirror.by_tray(1, 1)["id"] == 2
+
+
+def test_remove():
+    mirror = make_mirror(make_spool(1, "aaa", 1, 1))
+
+    mirror.remove(1)
+
+    assert mirror.get(1) is None
+    assert mirror.by_uuid("aaa") is None
+    assert mirror.by_tray(1, 1) is None
+
+
+def test_without_fields():
+    mirror = SpoolMirror()
+    mirror.replace([make_spool(1, "aaa", 1, 1)])
+
+    assert mirror.by_uuid("aaa") is None
+    assert mirror.by_tray(1, 1) is None
+
+
+def test_replace_keeps_serving_until_complete():
+    mirror = make_mirror(make_spool(1, "aaa"))
+
+    def listing():
+        # The old contents are still served while the listing is consumed
+        assert mirror.by_uuid("aaa")["id"] == 1
+        yield make_spool(2, "bbb")
+
+    mirror.replace(listing())
+
+    assert mirror.get(1) is None
+    assert mirror.by_uuid("bbb")["id"] == 2
+
+
+def test_replace_replays_changes_made_during_listing():
+    mirror = make_mirror(make_spool(1, "aaa"), make_spool(2, "bbb"))
+
+    def listing():
+        yield make_spool(1, "aaa")
+        # Changes published while the listing is being read, which the
+        # listing may or may not already include
+        mirror.update(make_spool(1, "ccc"))
+        mirror.remove(2)
+        mirror.update(make_spool(3, "ddd"))
+        yield make_spool(2, "bbb")
+
+    mirror.replace(listing())
+
+    assert mirror.by_uuid("aaa") is None
+    assert mirror.by_uuid("ccc")["id"] == 1
+    assert mirror.get(2) is None
+    assert mirror.by_uuid("bbb") is None
+    assert mirror.by_uuid("ddd")["id"] == 3
+
+
+def test_failed_replace_keeps_the_old_contents():
+    mirror = make_mirror(make_spool(1, "aaa"))
+
+    def listing():
+        yield make_spool(2, "bbb")
+        raise ConnectionError("Spoolman went away")
+
+    with pytest.raises(ConnectionError):
+        mirror.replace(listing())
+
+    assert mirror.by_uuid("aaa")["id"] == 1
+    assert mirror.get(2) is None
+
+    # Changes aren't recorded for replaying any more
+    mirror.update(make_spool(3))
+    mirror.replace([make_spool(4)])
+    assert mirror.get(3) is None
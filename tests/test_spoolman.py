@@ -0,0 +1,187 @@
+import json
+import re
+
+import pytest
+import requests
+
+from bambu_spoolman.spoolman import SpoolmanClient
+
+
+class FakeSpoolmanSession:
+    """
+    Answers the spool routes of the Spoolman API from a dict of spools
+    """
+
+    def __init__(self, spools):
+        self.spools = {spool["id"]: spool for spool in spools}
+        self.requests = []
+
+    def request(self, method, url, timeout=None, json=None):
+        self.requests.append((method, url, json))
+        path, _, query = url.partition("?")
+
+        if match := re.search(r"/spool/(\d+)$", path):
+            spool = self.spools.get(int(match.group(1)))
+            if spool is None:
+                return _response(404, {"message": "Not found"})
+            if method == "PATCH":
+                spool.update(json)
+            return _response(200, spool)
+        if path.endswith("/spool"):
+            return self._list(dict(p.split("=") for p in query.split("&")))
+        raise AssertionError(f"Unexpected request {method} {url}")
+
+    def _list(self, params):
+        spools = sorted(self.spools.values(), key=lambda spool: spool["id"])
+        offset = int(params["offset"])
+        page = spools[offset : offset + int(params["limit"])]
+        return _response(200, page, {"X-Total-Count": str(len(spools))})
+
+    def sent(self, method):
+        return [request for request in self.requests if request[0] == method]
+
+
+def _response(status, body, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+def make_spool(spool_id, **extra):
+    return {
+        "id": spool_id,
+        "filament": {"id": 1},
+        "extra": {name: f'"{value}"' for name, value in extra.items()},
+    }
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    monkeypatch.setenv("SPOOLMAN_SPOOL_FIELD_NAME", "tag")
+    monkeypatch.setenv("SPOOLMAN_AMS_FIELD_NAME", "ams")
+    monkeypatch.setenv("SPOOLMAN_TRAY_FIELD_NAME", "tray")
+
+    def make_client(*spools):
+        client = SpoolmanClient("http://spoolman")
+        client.session = FakeSpoolmanSession(spools)
+        return client
+
+    return make_client
+
+
+def test_update_extra_sends_all_extra_fields(make_client):
+    client = make_client(make_spool(1, tag="aaa", note="keep"))
+
+    assert client.update_extra(1, {"tag": '"bbb"'})
+
+    assert client.session.sent("PATCH") == [
+        (
+            "PATCH",
+            "http://spoolman/api/v1/spool/1",
+            {"extra": {"tag": '"bbb"', "note": '"keep"'}},
+        )
+    ]
+
+
+def test_update_extra_skips_unchanged_fields(make_client):
+    client = make_client(make_spool(1, tag="aaa", ams="1", tray="2"))
+
+    assert client.update_extra(1, {"tag": '"aaa"', "ams": '"1"'})
+
+    assert client.session.sent("PATCH") == []
+
+
+def test_update_extra_reuses_a_just_written_spool(make_client):
+    client = make_client(make_spool(1, tag="aaa"))
+
+    client.set_tray_uuid(1, "bbb")
+    client.set_active_tray(1, 1, 2)
+    client.set_active_tray(1, 1, 2)
+
+    assert [method for method, _, _ in client.session.requests] == [
+        "GET",
+        "PATCH",
+        "PATCH",
+    ]
+
+
+def test_update_extra_of_missing_spool(make_client):
+    client = make_client()
+
+    assert not client.update_extra(1, {"tag": '"aaa"'})
+    assert client.session.sent("PATCH") == []
+
+
+def test_set_tray_uuid_with_tray_sends_one_patch(make_client):
+    client = make_client(make_spool(1))
+
+    assert client.set_tray_uuid(1, "aaa", 2, 3)
+
+    assert client.session.sent("PATCH") == [
+        (
+            "PATCH",
+            "http://spoolman/api/v1/spool/1",
+            {"extra": {"tag": '"aaa"', "ams": '"2"', "tray": '"3"'}},
+        )
+    ]
+    # Locking the spool in its tray afterwards has nothing left to change
+    assert client.set_active_tray(1, 2, 3)
+    assert len(client.session.sent("PATCH")) == 1
+
+
+def spool_pages(session):
+    return [
+        url.partition("?")[2]
+        for method, url, _ in session.requests
+        if method == "GET" and url.partition("?")[0].endswith("/spool")
+    ]
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 5])
+def test_iter_spools_pages(make_client, count):
+    client = make_client(*(make_spool(i) for i in range(1, count + 1)))
+    client.page_size = 2
+
+    spools = list(client.iter_spools())
+
+    assert [spool["id"] for spool in spools] == list(range(1, count + 1))
+    # Stops on a short page, or once the total count is reached
+    assert len(spool_pages(client.session)) == max(1, -(-count // 2))
+
+
+def test_iter_spools_without_total_count(make_client):
+    client = make_client(*(make_spool(i) for i in range(1, 5)))
+    client.page_size = 2
+    list_spools = client.session._list
+
+    def list_without_total(params):
+        response = list_spools(params)
+        del response.headers["X-Total-Count"]
+        return response
+
+    client.session._list = list_without_total
+
+    assert [spool["id"] for spool in client.iter_spools()] == [1, 2, 3, 4]
+    # A full last page can only be told apart by the empty page after it
+    assert spool_pages(client.session)[-1].endswith("offset=4")
+    assert len(spool_pages(client.session)) == 3
+
+
+def test_iter_spools_query(make_client):
+    client = make_client(make_spool(1))
+
+    list(client.iter_spools(allow_archived=True))
+
+    assert spool_pages(client.session) == [
+        "allow_archived=true&sort=id%3Aasc&limit=500&offset=0"
+    ]
+
+
+def test_get_spools_fills_the_mirror(make_client):
+    client = make_client(make_spool(1, tag="aaa"), make_spool(2))
+    client.page_size = 1
+
+    assert [spool["id"] for spool in client.get_spools()] == [1, 2]
+    assert client.mirror.by_uuid("aaa")["id"] == 1
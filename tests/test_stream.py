@@ -0,0 +1,150 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from bambu_spoolman.gcode.stream import Pipe, PipeClosed, iter_zip_members
+
+MEMBERS = {
+    "Metadata/plate_1.gcode": b"M620 S0A\nG1 E1\n" * 5000,
+    "Metadata/plate_1.json": b'{"filament_ids": [0]}',
+    "3D/3dmodel.model": os.urandom(70000),
+    "empty.txt": b"",
+}
+
+
+class _Unseekable(io.RawIOBase):
+    """
+    A write-only stream, which makes zipfile write data descriptors
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_zip(compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for name, data in MEMBERS.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def make_streamed_zip(force_zip64=False):
+    output = _Unseekable()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in MEMBERS.items():
+            with archive.open(name, "w", force_zip64=force_zip64) as member:
+                member.write(data)
+    return bytes(output.data)
+
+
+def chunked(data, size=1000):
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+def read_all(data, chunk_size=1000):
+    contents = {}
+    for member in iter_zip_members(chunked(data, chunk_size)):
+        parts = []
+        member.decompress_into(parts.append)
+        contents[member.filename] = b"".join(parts)
+    return contents
+
+
+def read_with_zipfile(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        make_zip(zipfile.ZIP_DEFLATED),
+        make_zip(zipfile.ZIP_STORED),
+        make_streamed_zip(),
+        make_streamed_zip(force_zip64=True),
+    ],
+    ids=["deflated", "stored", "data_descriptor", "data_descriptor_zip64"],
+)
+@pytest.mark.parametrize("chunk_size", [7, 1000, 1 << 20])
+def test_matches_zipfile(data, chunk_size):
+    assert read_all(data, chunk_size) == read_with_zipfile(data)
+
+
+def test_data_descriptor_members():
+    data = make_streamed_zip()
+    members = list(iter_zip_members(chunked(data)))
+    assert all(member.has_data_descriptor for member in members)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for member in members:
+            info = archive.getinfo(member.filename)
+            assert (member.CRC, member.file_size) == (info.CRC, info.file_size)
+            assert member.compress_size == info.compress_size
+
+
+@pytest.mark.parametrize(
+    "data", [make_zip(), make_streamed_zip()], ids=["sized", "data_descriptor"]
+)
+def test_unread_members_are_skipped(data):
+    wanted = "Metadata/plate_1.json"
+    contents = {}
+    for member in iter_zip_members(chunked(data)):
+        if member.filename == wanted:
+            parts = []
+            member.decompress_into(parts.append)
+            contents[member.filename] = b"".join(parts)
+    assert contents == {wanted: MEMBERS[wanted]}
+
+
+def test_stored_member_with_data_descriptor():
+    data = bytearray(make_zip(zipfile.ZIP_STORED))
+    # Set the data descriptor flag in the first local header
+    data[6] |= 0x8
+    member = next(iter_zip_members([bytes(data)]))
+    with pytest.raises(zipfile.BadZipFile):
+        member.decompress_into(lambda data: None)
+
+
+def test_corrupt_member():
+    data = bytearray(make_zip(zipfile.ZIP_STORED))
+    offset = data.index(MEMBERS["Metadata/plate_1.gcode"][:16])
+    data[offset] ^= 0xFF
+    member = next(iter_zip_members([bytes(data)]))
+    with pytest.raises(zipfile.BadZipFile):
+        member.decompress_into(lambda data: None)
+
+
+def test_pipe():
+    pipe = Pipe()
+    pipe.write(b"a")
+    pipe.write(b"")
+    pipe.write(b"b")
+    pipe.finish()
+    assert list(pipe) == [b"a", b"b"]
+
+
+def test_pipe_error():
+    pipe = Pipe()
+    pipe.write(b"a")
+    pipe.finish(ValueError("broken"))
+    with pytest.raises(ValueError):
+        list(pipe)
+
+
+def test_closed_pipe():
+    pipe = Pipe(depth=1)
+    pipe.write(b"a")
+    pipe.close()
+    with pytest.raises(PipeClosed):
+        pipe.write(b"b")
+    with pytest.raises(PipeClosed):
+        list(pipe)
@@ -0,0 +1,37 @@
+from bambu_spoolman.gcode.usage import LayerUsage
+
+
+def make_usage():
+    return LayerUsage({0: {0: 1.0}, 1: {0: 2.0, 1: 0.5}, 3: {1: 1.5}})
+
+
+def test_layer():
+    usage = make_usage()
+    assert usage.layer(1) == {0: 2.0, 1: 0.5}
+    assert usage.layer(2) == {}
+    assert usage.layer(3) == {1: 1.5}
+
+
+def test_between():
+    usage = make_usage()
+    assert usage.between(0, 1) == {0: 3.0, 1: 0.5}
+    assert usage.between(2, 3) == {1: 1.5}
+    assert usage.between(2, 2) == {}
+
+
+def test_between_clamps_to_known_layers():
+    usage = make_usage()
+    assert usage.between(-5, 100) == usage.totals()
+    assert usage.totals() == {0: 3.0, 1: 2.0}
+
+
+def test_first_and_last_layer():
+    usage = make_usage()
+    assert (usage.first_layer, usage.last_layer) == (0, 3)
+
+
+def test_empty():
+    usage = LayerUsage({})
+    assert (usage.first_layer, usage.last_layer) == (0, -1)
+    assert usage.totals() == {}
+    assert usage.between(0, 10) == {}